@@ -1,7 +1,7 @@
-import logging
-from concordancer.server import download_query_interface
-
-try:
-    download_query_interface(force=True)
-except:
-    logging.warning("Skip download query interface")
\ No newline at end of file
+def __getattr__(name):
+    # The server (and falcon) is only imported when it is used, so that
+    # batch jobs importing the package start fast
+    if name == 'download_query_interface':
+        from concordancer.server import download_query_interface
+        return download_query_interface
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
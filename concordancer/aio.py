@@ -0,0 +1,121 @@
+import asyncio
+import threading
+from itertools import islice
+from concurrent.futures import Executor, ThreadPoolExecutor
+from .concordancer import Concordancer, SearchCancelled
+
+
+class AsyncConcordancer:
+    """Search a :class:`~concordancer.concordancer.Concordancer` from
+    asyncio code without blocking the event loop
+
+    Searches run on an executor, and their results are handed back
+    to the event loop in batches. At most ``max_concurrency`` batches
+    are computed at the same time, however many searches are iterated
+    concurrently. When the iteration of a search is cancelled or
+    stopped early, the search is stopped in the executor as well.
+    """
+
+    def __init__(self, concordancer: Concordancer, executor: Executor=None, max_concurrency: int=4, batch_size: int=100):
+        """Wrap a Concordancer for asyncio
+
+        Parameters
+        ----------
+        concordancer : Concordancer
+            The corpus to search
+        executor : Executor, optional
+            The executor running the searches, by default None, which
+            creates a thread pool of ``max_concurrency`` workers
+        max_concurrency : int, optional
+            Maximum number of batches computed at the same time,
+            by default 4
+        batch_size : int, optional
+            Number of results in a batch, by default 100
+        """
+        self.C = concordancer
+        self.max_concurrency = max_concurrency
+        self.batch_size = batch_size
+        self._own_executor = executor is None
+        self.executor = executor or ThreadPoolExecutor(max_workers=max_concurrency)
+        self._semaphore = None
+
+    async def cql_search(self, cql: str, left=5, right=5, batch_size: int=None, **kwargs):
+        """Search the corpus with Corpus Query Language
+
+        Parameters
+        ----------
+        cql : str
+            A CQL query
+        left : int, optional
+            Left context size, by default 5
+        right : int, optional
+            Right context size, by default 5
+        batch_size : int, optional
+            Number of results in a batch, by default None, which uses
+            the batch size given when initializing
+        **kwargs
+            Other arguments of
+            :meth:`~concordancer.concordancer.Concordancer.cql_search`,
+            e.g., ``sample`` or ``sort_by``, except ``hits``
+
+        Yields
+        -------
+        list
+            A batch of results, with the same structure as the results
+            yielded by
+            :meth:`~concordancer.concordancer.Concordancer.cql_search`
+
+        Raises
+        ------
+        ValueError
+            If ``hits`` is given, since hit sets are not yielded in
+            batches. A hit set could be computed on the executor with
+            ``loop.run_in_executor()`` instead.
+        """
+        if kwargs.get('hits'):
+            raise ValueError("hits=True is not supported by AsyncConcordancer.cql_search")
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        batch_size = batch_size or self.batch_size
+        cancel = threading.Event()
+        results = self.C.cql_search(cql, left=left, right=right, cancel=cancel, **kwargs)
+        future = None
+        try:
+            while True:
+                async with self._semaphore:
+                    future = self.executor.submit(_next_batch, results, batch_size)
+                    batch = await asyncio.wrap_future(future)
+                if len(batch) == 0:
+                    return
+                yield batch
+        finally:
+            cancel.set()
+            # The generator can only be closed once the batch computed
+            # in the executor is done
+            if future is not None and not future.cancel() and not future.done():
+                future.add_done_callback(lambda _: results.close())
+            else:
+                results.close()
+
+    async def cql_search_all(self, cql: str, left=5, right=5, **kwargs):
+        """Search the corpus with Corpus Query Language and collect
+        all results in a list. The parameters are the same as
+        :meth:`cql_search`.
+        """
+        results = []
+        async for batch in self.cql_search(cql, left=left, right=right, **kwargs):
+            results.extend(batch)
+        return results
+
+    def close(self):
+        """Shut down the executor if it was created by this object
+        """
+        if self._own_executor:
+            self.executor.shutdown(wait=False)
+
+
+def _next_batch(results, batch_size):
+    try:
+        return list(islice(results, batch_size))
+    except SearchCancelled:
+        return []
@@ -0,0 +1,154 @@
+"""The ``concordancer`` command
+
+Subcommands work against corpora saved by
+:meth:`~concordancer.indexedCorpus.IndexedCorpus.save`, so that a corpus
+is indexed once and then queried by short-lived processes::
+
+    concordancer index corpus.jsonl corpus_index/
+    concordancer query corpus_index/ '"打" [pos="N.*"]'
+    concordancer export corpus_index/ '"打" [pos="N.*"]' results.tsv
+    concordancer serve corpus_index/
+
+Modules only needed by some subcommands (e.g., the server) are imported
+when the subcommand runs.
+"""
+import sys
+import json
+import argparse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='concordancer', description="Index and search corpora with CQL")
+    commands = parser.add_subparsers(dest='command', metavar='<command>')
+    commands.required = True
+
+    p = commands.add_parser('index', help="index a corpus and save the index",
+                            description="Index a corpus saved as newline-delimited JSON (optionally gzipped), "
+                                        "one text per line, and save the index to a directory")
+    p.add_argument('corpus', help="path to the corpus (.jsonl or .jsonl.gz), or - for stdin")
+    p.add_argument('index', help="directory to save the index")
+    p.add_argument('--text-key', default='text',
+                   help="key of the tokens in a text, by default 'text'; '' if texts are nested lists")
+    p.set_defaults(func=index_command)
+
+    p = commands.add_parser('query', help="search a saved corpus",
+                            description="Search a saved corpus and print the results")
+    _add_search_arguments(p)
+    p.add_argument('--format', default='kwic', choices=['kwic', 'jsonl'],
+                   help="print results in keyword-in-context format or as JSON lines")
+    p.add_argument('--attrs', help="comma-separated attributes of tokens to print, by default all")
+    p.add_argument('--sample', type=int, help="print a random sample of results")
+    p.add_argument('--seed', type=int, help="seed of the random sample")
+    p.add_argument('--sort-by', action='append', metavar='WHERE:N:ATTR',
+                   help="sort results, e.g., right:1:word (repeatable)")
+    p.add_argument('--page', type=int, help="print a single page of results")
+    p.add_argument('--page-size', type=int, default=50)
+    p.set_defaults(func=query_command)
+
+    p = commands.add_parser('export', help="write the results of a query to a file",
+                            description="Write the results of a query on a saved corpus to a file")
+    _add_search_arguments(p)
+    p.add_argument('output', help="path to the output file, gzipped if it ends with .gz")
+    p.add_argument('--format', default='jsonl', choices=['jsonl', 'json', 'tsv', 'csv'])
+    p.add_argument('--attrs', help="comma-separated attributes of tokens to export, by default all")
+    p.set_defaults(func=export_command)
+
+    p = commands.add_parser('serve', help="serve saved corpora to the query interface",
+                            description="Serve a saved corpus, or several corpora given as NAME=INDEX")
+    p.add_argument('index', nargs='+', help="directory of a saved corpus, or NAME=INDEX")
+    p.add_argument('--port', type=int, default=1420)
+    p.add_argument('--no-browser', action='store_true', help="do not open the query interface")
+    p.add_argument('--memory-limit', type=int, help="bytes of loaded corpora, when serving several")
+    p.set_defaults(func=serve_command)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+def index_command(args):
+    from .concordancer import Concordancer
+
+    # Texts are read one at a time instead of loading the whole file
+    with _open_corpus(args.corpus) as f:
+        corpus = ( json.loads(l) for l in f if l.strip() )
+        C = Concordancer([], text_key=args.text_key or None)
+        C.add_documents(corpus)
+    C.save(args.index)
+    print(f"Indexed {C.tokens.n_docs} texts ({len(C.tokens)} tokens) into {args.index}", file=sys.stderr)
+
+
+def query_command(args):
+    _check_cql(args.cql)
+    C = _load(args.index)
+    sort_by = None
+    if args.sort_by:
+        sort_by = [ (where, int(n), attr) for where, n, attr in (s.split(':', 2) for s in args.sort_by) ]
+    results = C.cql_search(args.cql, left=args.left, right=args.right, sample=args.sample,
+                           seed=args.seed, sort_by=sort_by, page=args.page, page_size=args.page_size)
+    attrs = args.attrs.split(',') if args.attrs else C.tokens.attrs
+
+    if args.format == 'kwic':
+        from .kwic_print import KWIC
+        KWIC(results, attrs=attrs)
+    else:
+        from .export import ConcordanceWriter
+        writer = ConcordanceWriter('jsonl', attrs=args.attrs.split(',') if args.attrs else None)
+        for result in results:
+            sys.stdout.write(writer.line(result))
+
+
+def export_command(args):
+    _check_cql(args.cql)
+    C = _load(args.index)
+    attrs = args.attrs.split(',') if args.attrs else None
+    n = C.export(args.cql, args.output, format=args.format, attrs=attrs, left=args.left, right=args.right)
+    print(f"Exported {n} results to {args.output}", file=sys.stderr)
+
+
+def serve_command(args):
+    from . import server
+
+    if len(args.index) == 1 and '=' not in args.index[0]:
+        C = _load(args.index[0])
+        server.run(C, port=args.port, open_browser=not args.no_browser)
+    else:
+        corpora = {}
+        for item in args.index:
+            name, sep, path = item.partition('=')
+            if not sep:
+                raise SystemExit(f"concordancer serve: expected NAME=INDEX, got {item}")
+            corpora[name] = path
+        server.run_registry(corpora, port=args.port, memory_limit=args.memory_limit)
+
+
+def _add_search_arguments(parser):
+    parser.add_argument('index', help="directory of a saved corpus")
+    parser.add_argument('cql', help="CQL query")
+    parser.add_argument('--left', type=int, default=5, help="left context size")
+    parser.add_argument('--right', type=int, default=5, help="right context size")
+
+
+def _check_cql(cql):
+    from .utils import parse_cql
+    try:
+        parse_cql(cql)
+    except Exception:
+        raise SystemExit(f"concordancer: CQL syntax error in {cql}")
+
+
+def _load(index):
+    from .concordancer import Concordancer
+    return Concordancer.load(index)
+
+
+def _open_corpus(path):
+    if path == '-':
+        return open(sys.stdin.fileno(), encoding='utf-8', closefd=False)
+    if path.endswith('.gz'):
+        import gzip
+        return gzip.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+if __name__ == '__main__':
+    main()
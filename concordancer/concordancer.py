@@ -1,34 +1,102 @@
+import os
 import re
+import gzip
 import math
-import cqls
-from typing import Union
+import queue
+import random
+import threading
+from array import array
+from typing import Union, Iterable, Mapping
 from copy import deepcopy
-from collections import Counter
-from .utils import queryMatchToken, match_mode
+from concurrent.futures import ThreadPoolExecutor
+from .utils import queryMatchToken, match_mode, append_regex_anchors, parse_cql, split_within, value_flags, fold_function, fold_regex, WITHIN_UNITS
 from .indexedCorpus import IndexedCorpus
+from .tokenStore import POSITION_TYPE
+from .postings import intersect
+from .hitSet import HitSet
+from .export import ConcordanceWriter, query_labels
+
+
+_regex_pool_lock = threading.Lock()
+
+# Kinds of the items passed from the workers of cql_search_many()
+_RESULT, _QUERY_DONE, _QUERY_FAILED = range(3)
+
+
+class SearchCancelled(Exception):
+    """Raised when a search is stopped by setting its ``cancel`` event
+    """
 
 
 class Concordancer(IndexedCorpus):
 
     _cql_default_attr = "word"
     _cql_max_quantity = 6
+    _cql_default_within = "s"
+    _regex_parallel_threshold = None
+    _regex_workers = None
+    _regex_pool = None
 
-    def cql_search(self, cql: str, left=5, right=5):
+    def cql_search(self, cql: str, left=5, right=5, sample: int=None, seed=None, sort_by: Union[tuple, list]=None, page: int=None, page_size=50, cancel: threading.Event=None, hits: bool=False):
         """Search the corpus with Corpus Query Language
 
         Parameters
         ----------
         cql : str
-            A CQL query
+            A CQL query. Matches are confined to a sentence, unless the
+            query ends with ``within doc``, which allows matches to span
+            sentences of the same document (e.g., 
+            ``"。" [pos="Nh"] within doc``). ``within s`` confines the
+            matches to a sentence explicitly. The default could be
+            changed with :meth:`set_cql_parameters`.
         left : int, optional
             Left context size, by default 5
         right : int, optional
             Right context size, by default 5
+        sample : int, optional
+            Return a random sample of ``sample`` results, by default None,
+            which returns all results. Results are sampled before any 
+            concordance line is built, and are returned in the order 
+            they appear in the corpus (unless ``sort_by`` is given).
+        seed : optional
+            Seed of the random sampling, by default None
+        sort_by : Union[tuple, list], optional
+            Sort the results by the tokens around the keywords, by 
+            default None. A sort key is a tuple ``(<where>, <n>, <attr>)``,
+            where ``<where>`` is one of ``"left"``, ``"keyword"``, or 
+            ``"right"``, and ``<n>`` counts tokens from the keywords 
+            (starting from 1). For instance, ``("right", 1, "word")``
+            sorts the results by the ``word`` of the first token to 
+            the right of the keywords, and ``("left", 1, "pos")`` by 
+            the ``pos`` of the token right before the keywords. A list 
+            of sort keys sorts by the first key, then by the second, 
+            and so on. Values are compared as strings, and results 
+            without a token at the given position come first.
+        page : int, optional
+            Return only the ``page``-th (starting from 0) page of the 
+            results, by default None, which returns all results. Only 
+            the concordance lines on the page are built.
+        page_size : int, optional
+            Number of results in a page, by default 50
+        cancel : threading.Event, optional
+            An event that stops the search when set, by default None.
+            It is checked while the candidates of the keywords are
+            verified, so a search running in another thread stops
+            early instead of going through all candidates.
+        hits : bool, optional
+            Return the results as a :class:`~concordancer.hitSet.HitSet`,
+            by default False. A hit set keeps the positions of the 
+            results only, which could be intersected, subtracted, or 
+            merged with the results of other queries, or filtered by 
+            the distance to them, before any concordance line is built.
+            ``sort_by`` and ``page`` are not supported with ``hits``.
 
-        Yields
+        Returns
         -------
-        dict
-            A dictionary with the structure:
+        Union[Generator, HitSet]
+            A generator of concordance lines (or a hit set, if ``hits``
+            is True). A concordance line is a dictionary with the 
+            structure:
 
             .. code-block:: python
 
@@ -56,15 +124,213 @@ class Concordancer(IndexedCorpus):
                     'lemma': 'hit',
                     'pos': 'V',
                 }
+
+        Raises
+        ------
+        SearchCancelled
+            If ``cancel`` is set before the search completes
+        ValueError
+            If ``hits`` is given with ``sort_by`` or ``page``
         """
-        queries = cqls.parse(cql, default_attr=self._cql_default_attr,max_quant=self._cql_max_quantity)
+        queries = parse_cql(cql, default_attr=self._cql_default_attr, max_quant=self._cql_max_quantity)
+        within = self._cql_within(cql)
+
+        if hits:
+            if sort_by is not None or page is not None:
+                raise ValueError("sort_by and page are not supported with hits=True")
+            positions, query_ids = self._collect_hits(queries, cancel=cancel, within=within)
+            hit_set = HitSet.from_positions(self, positions, query_ids, queries, left=left, right=right)
+            return hit_set if sample is None else hit_set.sample(sample, seed=seed)
+        return self._cql_results(queries, within, left, right, sample, seed, sort_by, page, page_size, cancel)
+
+
+    def _cql_results(self, queries: list, within: str, left=5, right=5, sample: int=None, seed=None, sort_by: Union[tuple, list]=None, page: int=None, page_size=50, cancel: threading.Event=None):
+        # Concordance lines of the results of cql_search()
+        if sample is None and sort_by is None and page is None:
+            for query in queries:
+                for result in self._kwic(keywords=query, left=left, right=right, cancel=cancel, within=within):
+                    yield result
+            return
+
+        # Collect positions of all results before building concordance lines
+        positions, query_ids = self._collect_hits(queries, cancel=cancel, within=within)
+        order = range(len(positions))
+        if sample is not None and sample < len(order):
+            order = sorted(random.Random(seed).sample(order, sample), key=positions.__getitem__)
+        if sort_by is not None:
+            sort_key = self._sort_key(sort_by)
+            order = sorted(order, key=lambda i: sort_key(positions[i], len(queries[query_ids[i]])))
+        if page is not None:
+            order = order[page * page_size:(page + 1) * page_size]
+
+        for i in order:
+            query = queries[query_ids[i]]
+            yield self._kwic_single(positions[i], tk_len=len(query), left=left, right=right, keywords=query)
+
+
+    def cql_search_many(self, queries: Union[Mapping, Iterable], left=5, right=5, workers: int=None):
+        """Search the corpus with a batch of CQL queries
+
+        Token specifications shared by queries in the batch (e.g. 
+        ``[pos="V.*"]``) are resolved against the index only once, 
+        and the queries are then evaluated on a pool of worker threads.
+
+        Searches run in pure Python and hold the GIL, so the threads 
+        give no CPU parallelism: the speedup over calling 
+        :meth:`cql_search` for each query comes from the shared 
+        lookups. The threads only keep a query with many results from
+        holding back the results of the others.
+
+        Parameters
+        ----------
+        queries : Union[Mapping, Iterable]
+            A dictionary mapping query ids to CQL queries, or an
+            iterable of CQL queries, in which case the position of 
+            a query in the iterable is used as its id
+        left : int, optional
+            Left context size, by default 5
+        right : int, optional
+            Right context size, by default 5
+        workers : int, optional
+            Number of worker threads, by default None, which uses 
+            the default of :class:`concurrent.futures.ThreadPoolExecutor`
+
+        Yields
+        -------
+        tuple
+            A tuple ``(query_id, result)``, where ``result`` has the
+            same structure as the results yielded by 
+            :meth:`cql_search`. Results are yielded as soon as they
+            are found, so results of different queries may be 
+            interleaved, although the results of a query come in the
+            order :meth:`cql_search` yields them.
+        """
+        if isinstance(queries, Mapping):
+            queries = queries.items()
+        else:
+            queries = enumerate(queries)
+
+        # Parse queries and collect distinct token specifications
+        parsed = []
+        distinct_keywords = {}
+        for query_id, cql in queries:
+            query = parse_cql(cql, default_attr=self._cql_default_attr, max_quant=self._cql_max_quantity)
+            parsed.append((query_id, query, self._cql_within(cql)))
+            for keywords in query:
+                for keyword in keywords:
+                    distinct_keywords.setdefault(keyword_key(keyword), keyword)
+
+        if workers is None:
+            workers = min(32, (os.cpu_count() or 1) + 4)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            # Resolve every distinct token once
+            cache = {}
+            resolved = executor.map(lambda kw: self._search_keyword(kw, cache=cache), distinct_keywords.values())
+            for key, positions in zip(distinct_keywords, resolved):
+                cache[key] = positions
+
+            # Evaluate queries against the shared lookups. Results are
+            # passed on through a bounded queue as they are found, and 
+            # the workers stop when the caller stops iterating
+            results = queue.Queue(maxsize=64 * workers)
+            cancel = threading.Event()
+
+            def put(item):
+                while True:
+                    try:
+                        results.put(item, timeout=0.1)
+                        return
+                    except queue.Full:
+                        if cancel.is_set():
+                            raise SearchCancelled()
+
+            def evaluate(query_id, query, within):
+                try:
+                    for keywords in query:
+                        for result in self._kwic(keywords=keywords, left=left, right=right, cache=cache, cancel=cancel, within=within):
+                            put((_RESULT, query_id, result))
+                    put((_QUERY_DONE, query_id, None))
+                except SearchCancelled:
+                    pass
+                except Exception as e:
+                    put((_QUERY_FAILED, query_id, e))
+
+            parsed = iter(parsed)
+
+            def start_next():
+                item = next(parsed, None)
+                if item is None:
+                    return 0
+                executor.submit(evaluate, *item)
+                return 1
+
+            try:
+                running = sum( start_next() for _ in range(workers) )
+                while running:
+                    kind, query_id, result = results.get()
+                    if kind == _RESULT:
+                        yield query_id, result
+                    elif kind == _QUERY_FAILED:
+                        raise result
+                    else:
+                        running += start_next() - 1
+            finally:
+                cancel.set()
+
+
+    def export(self, cql: str, path: str, format="jsonl", attrs: list=None, left=5, right=5, compress: bool=None):
+        """Search the corpus with CQL and write the results to a file
+
+        Results are written to the file as soon as they are found,
+        without being collected in memory first.
+
+        Parameters
+        ----------
+        cql : str
+            A CQL query
+        path : str
+            Path to the output file
+        format : str, optional
+            ``"jsonl"`` (one result per line, structured as the results 
+            of :meth:`cql_search`), ``"json"``, ``"tsv"``, or ``"csv"``,
+            by default ``"jsonl"``. See 
+            :class:`~concordancer.export.ConcordanceWriter` for the 
+            columns of ``tsv`` and ``csv``.
+        attrs : list, optional
+            The attributes of the tokens to export, by default None,
+            which exports all attributes
+        left : int, optional
+            Left context size, by default 5
+        right : int, optional
+            Right context size, by default 5
+        compress : bool, optional
+            Whether to gzip-compress the file, by default None, which 
+            compresses the file if ``path`` ends with ``.gz``
 
-        for query in queries:
-            for result in self._kwic(keywords=query, left=left, right=right):
-                yield result
+        Returns
+        -------
+        int
+            Number of results written
+        """
+        if compress is None:
+            compress = str(path).endswith('.gz')
+        queries = parse_cql(cql, default_attr=self._cql_default_attr, max_quant=self._cql_max_quantity)
+        writer = ConcordanceWriter(format, attrs=attrs, labels=query_labels(queries))
+
+        n = 0
+        opener = gzip.open if compress else open
+        with opener(path, 'wt', encoding='utf-8', newline='') as f:
+            f.write(writer.header())
+            for result in self.cql_search(cql, left=left, right=right):
+                f.write(writer.line(result))
+                n += 1
+            f.write(writer.footer())
+        
+        return n
 
 
-    def set_cql_parameters(self, default_attr: str, max_quant: int=6):
+    def set_cql_parameters(self, default_attr: str, max_quant: int=6, within: str="s"):
         """Set parameters for CQL queries in the Concordancer
 
         Parameters
@@ -81,44 +347,144 @@ class Concordancer(IndexedCorpus):
             infinite, but since the computer cannot generate a infinite number
             of queries, an upper bound of the quantifier must be specified. 
             By default, it is set to 6.
+        within : str, optional
+            The structure that matches of queries without a ``within``
+            clause are confined to, ``"s"`` (sentence) or ``"doc"``
+            (document), by default ``"s"``
         """
+        if within not in WITHIN_UNITS:
+            raise ValueError(f"Unknown structure: {within}")
         self._cql_default_attr = default_attr
         self._cql_max_quantity = max_quant
+        self._cql_default_within = WITHIN_UNITS[within]
+
 
+    def set_regex_parallelism(self, threshold: int=200000, workers: int=None):
+        """Match regular expressions in CQL queries against large 
+        vocabularies on a pool of processes
 
-    def _kwic(self, keywords: list, left=5, right=5):
+        By default, a regular expression (e.g., ``[word=".*ing"]``) is 
+        matched against every value of the attribute in a single 
+        thread. With a vocabulary of at least ``threshold`` values, 
+        the values are instead split into chunks matched in parallel
+        by ``workers`` processes. The workers are started the first time
+        they are needed, and again when the vocabulary has grown (e.g.,
+        after :meth:`add_documents`). Each worker holds a copy of the 
+        vocabularies.
+
+        Parameters
+        ----------
+        threshold : int, optional
+            Minimum size of a vocabulary to be matched in parallel, 
+            by default 200000. None disables parallel matching.
+        workers : int, optional
+            Number of worker processes, by default None, which uses
+            the number of CPUs
+        """
+        self._regex_parallel_threshold = threshold
+        self._regex_workers = workers
+        with _regex_pool_lock:
+            if self._regex_pool is not None:
+                self._regex_pool.shutdown()
+                self._regex_pool = None
+
+
+    def _extra_meta(self):
+        return {
+            'cql_default_attr': self._cql_default_attr, 
+            'cql_max_quantity': self._cql_max_quantity,
+            'cql_default_within': self._cql_default_within
+        }
+
+
+    def _restore_meta(self, meta: dict):
+        self.set_cql_parameters(meta['cql_default_attr'], meta['cql_max_quantity'], 
+                                meta.get('cql_default_within', "s"))
+
+
+    def _cql_within(self, cql: str):
+        return split_within(cql)[1] or self._cql_default_within
+
+
+    def _sort_key(self, sort_by: Union[tuple, list]):
+        """Build a function computing the sort key of a result 
+        from its position and length
+        """
+        if isinstance(sort_by, tuple):
+            sort_by = [sort_by]
+        store = self.tokens
+        keys = []
+        for where, n, attr in sort_by:
+            if where not in ('left', 'keyword', 'right'):
+                raise ValueError(f"Sort key should start with 'left', 'keyword', or 'right', not {where}")
+            if n < 1:
+                raise ValueError(f"Token counts in sort keys start from 1, not {n}")
+            if attr not in store.columns:
+                raise ValueError(f"Attribute {attr} not in corpus")
+            keys.append((where, n, store.columns[attr], store.vocab_ranks(attr)))
+
+        def sort_key(position, length):
+            doc_start, doc_end = store.doc_bounds(store.locate(position)[0])
+            key = []
+            for where, n, column, ranks in keys:
+                if where == 'left':
+                    idx = position - n
+                elif where == 'keyword':
+                    idx = position + n - 1
+                else:
+                    idx = position + length + n - 1
+                key.append(ranks[column[idx]] if doc_start <= idx < doc_end else -1)
+            return key
+
+        return sort_key
+
+
+    def _collect_hits(self, queries: list, cancel: threading.Event=None, within="s"):
+        # Positions of the results of all queries, and the index of the
+        # query of each result
+        positions = array(POSITION_TYPE)
+        query_ids = array(POSITION_TYPE)
+        for i, query in enumerate(queries):
+            found = self._search_keywords(query, cancel=cancel, within=within) or []
+            positions.extend(found)
+            query_ids.extend(array(POSITION_TYPE, [i]) * len(found))
+        return positions, query_ids
+
+
+    def _kwic(self, keywords: list, left=5, right=5, cache: dict=None, cancel: threading.Event=None, within="s"):
         # Get concordance from corpus
-        search_results = self._search_keywords(keywords)
+        search_results = self._search_keywords(keywords, cache=cache, cancel=cancel, within=within)
         if search_results is None: 
             return []
-        for doc_idx, sent_idx, tk_idx in search_results:
-            cc = self._kwic_single(doc_idx, sent_idx, tk_idx, tk_len=len(keywords), left=left, right=right, keywords=keywords)
+        for position in search_results:
+            if cancel is not None and cancel.is_set():
+                raise SearchCancelled()
+            cc = self._kwic_single(position, tk_len=len(keywords), left=left, right=right, keywords=keywords)
             yield cc
         
         
-    def _kwic_single(self, doc_idx, sent_idx, tk_idx, tk_len=1, left=5, right=5, keywords:list=None):
-        # Flatten doc sentences to a list of tokens
-        text, keyword_idx = flatten_doc_to_sent(self._get_corp_data(doc_idx))
+    def _kwic_single(self, position, tk_len=1, left=5, right=5, keywords:list=None):
+        store = self.tokens
+        doc_idx, sent_idx, tk_idx = store.locate(position)
+        doc_start, doc_end = store.doc_bounds(doc_idx)
 
-        tk_start_idx = keyword_idx(sent_idx, tk_idx)
-        tk_end_idx = tk_start_idx + tk_len
-        start_idx = max(tk_start_idx - left, 0)
-        end_idx = min(tk_end_idx + right, len(text))
+        tk_end_idx = position + tk_len
+        start_idx = max(position - left, doc_start)
+        end_idx = min(tk_end_idx + right, doc_end)
 
         # Get CQL labeled token positions
         captureGroups = {}
-        for i, keyword in enumerate(keywords):
+        for i, keyword in enumerate(keywords or []):
             if '__label__' in keyword:
                 for lab in keyword.get('__label__'):
                     if lab not in captureGroups:
                         captureGroups[lab] = []
-                    tk = self._get_corp_data(doc_idx, sent_idx, i + tk_idx)
-                    captureGroups[lab].append(tk)
+                    captureGroups[lab].append(store.token(position + i))
 
         return {
-            "left": text[start_idx:tk_start_idx],
-            "keyword": text[tk_start_idx:tk_end_idx],
-            "right": text[tk_end_idx:end_idx],
+            "left": store.tokens(start_idx, position),
+            "keyword": store.tokens(position, tk_end_idx),
+            "right": store.tokens(tk_end_idx, end_idx),
             "position": {
                 "doc_idx": doc_idx,
                 "sent_idx": sent_idx,
@@ -128,13 +494,15 @@ class Concordancer(IndexedCorpus):
         }
 
 
-    def _search_keywords(self, keywords: list):
+    def _search_keywords(self, keywords: list, cache: dict=None, cancel: threading.Event=None, within="s"):
         #########################################################
         # Find keywords with the least number of matching results 
         #########################################################
         best_search_loc = (0, None, math.inf)
         for i, keyword in enumerate(keywords):
-            results = self._search_keyword(keyword)
+            if cancel is not None and cancel.is_set():
+                raise SearchCancelled()
+            results = self._search_keyword(keyword, cache=cache)
             num_of_matched = len(results)
             if num_of_matched == 0: 
                 return None
@@ -152,24 +520,25 @@ class Concordancer(IndexedCorpus):
         
         # Check all possible matching keywords
         matched_results = []
-        for idx in results:
+        for idx in sorted(results):
+            if cancel is not None and cancel.is_set():
+                raise SearchCancelled()
             # Get all possible matching keywords from corpus
-            candidates = self._get_keywords(keyword_anchor, *idx)
+            candidates = self._get_keywords(keyword_anchor, idx, within=within)
             if len(candidates) != len(keywords): 
                 continue
             # Check every token in keywords
             matched_num = 0
             for w_k, w_c in zip(keywords, candidates):
-                if queryMatchToken(queryTerm=w_k, corpToken=w_c):
+                if queryMatchToken(queryTerm=w_k, corpToken=w_c, normalizers=self.normalizers):
                     matched_num += 1
             if matched_num == len(keywords):
-                first_keyword_idx = idx[2] - keyword_anchor['seed_idx']
-                matched_results.append( [idx[0], idx[1], first_keyword_idx] )
+                matched_results.append(idx - keyword_anchor['seed_idx'])
             
         return matched_results
 
 
-    def _search_keyword(self, keyword: dict):
+    def _search_keyword(self, keyword: dict, cache: dict=None):
         """Global search of a keyword to find candidates of correct kwic instances
 
         Parameters
@@ -190,12 +559,22 @@ class Concordancer(IndexedCorpus):
                     },
                     '__label__': ['l1']  #labels to attached to search results  
                 }
+        cache : dict, optional
+            Lookups shared across queries, by default None. Results
+            of tokens and attribute values already in the cache are 
+            reused, and new ones are added to it. The returned set 
+            may therefore be shared and must not be modified.
 
         Returns
         -------
-        list
-            A list of matching indicies
+        set
+            A set of matching indicies
         """
+        if cache is not None:
+            key = keyword_key(keyword)
+            if key in cache:
+                return cache[key]
+
         positive_match = set()
         negative_match = set()
 
@@ -207,26 +586,23 @@ class Concordancer(IndexedCorpus):
             ########################################
             ##########   POSITIVE MATCH   ##########
             ########################################
-            matching_idicies = Counter()
-            for tag, values in keyword['match'].items():
-                # Check all values of a specific tag
-                for idx in self._intersect_search(tag, values):
-                    matching_idicies.update({idx: 1})
-            
-            # Get indicies that matched all given tags 
-            for idx, count in matching_idicies.items():
-                if count == len(keyword['match']):
-                    positive_match.add(idx)
-            
+            if len(keyword['match']) > 1:
+                # Get indicies that matched all given tags
+                positive_match = self._join_tags(keyword['match'], cache=cache)
+            else:
+                for tag, values in keyword['match'].items():
+                    # Check all values of a specific tag
+                    positive_match = self._intersect_search(tag, values, cache=cache)
+
             # Special case: match is empty
             if len(keyword['match']) == 0:
-                positive_match = self.all_tk_idx
+                positive_match = set(self.all_tk_idx)
             
             ########################################
             ##########   NEGATIVE MATCH   ##########
             ########################################
             for tag, values in keyword['not_match'].items():
-                for idx in self._union_search(tag, values):
+                for idx in self._union_search(tag, values, cache=cache):
                     negative_match.add(idx)
 
             ########################################
@@ -237,10 +613,12 @@ class Concordancer(IndexedCorpus):
         if len(positive_match) == 0:
             print(f"{keyword} not found in corpus")
 
+        if cache is not None:
+            cache[key] = positive_match
         return positive_match
 
 
-    def _union_search(self, tag:Union[str, int], values:list):
+    def _union_search(self, tag:Union[str, int], values:list, cache: dict=None):
         """Given candidates values, return from corpus the position 
         of tokens matching any of the values
 
@@ -250,25 +628,18 @@ class Concordancer(IndexedCorpus):
             The tag of the token used for comparison
         values : list
             A list of values to compare with
+        cache : dict, optional
+            Lookups shared across queries, by default None
         """
         matched_indicies = set()
 
         for value in values:
-            value, mode = match_mode(value)
-            if mode == "literal":
-                if value in self.corp_idx[tag]:
-                    for idx in self.corp_idx[tag][value]: 
-                        matched_indicies.add(idx)
-            else:
-                for term in self.corp_idx[tag]:
-                    if re.search(value, term):
-                        for idx in self.corp_idx[tag][term]:
-                            matched_indicies.add(idx)
+            matched_indicies.update(self._value_search(tag, value, cache=cache))
         
         return matched_indicies
 
 
-    def _intersect_search(self, tag:Union[str, int], values:list):
+    def _intersect_search(self, tag:Union[str, int], values:list, cache: dict=None):
         """Given candidates values, return from corpus the position 
         of tokens matching all values
 
@@ -278,76 +649,189 @@ class Concordancer(IndexedCorpus):
             The tag of the token used for comparison
         values : list
             A list of values to compare with
+        cache : dict, optional
+            Lookups shared across queries, by default None
         """
         # Get intersections of all values
-        match_count = Counter()
+        intersect_match = None
         for value in values:
-            value, mode = match_mode(value)
-            indices = []
-            if mode == "literal":
-                if value in self.corp_idx[tag]:
-                    indices = self.corp_idx[tag][value]
+            indices = self._value_search(tag, value, cache=cache)
+            if intersect_match is None:
+                intersect_match = set(indices)
             else:
-                for term in self.corp_idx[tag]:
-                    if re.search(value, term):
-                        indices += self.corp_idx[tag][term]
-            
-            for idx in set(indices):
-                match_count.update({idx: 1})
+                intersect_match.intersection_update(indices)
         
-        # Filter idicies that match all values given
-        intersect_match = set()
-        for idx, count in match_count.items():
-            if count == len(values):
-                intersect_match.add(idx)
-        
-        return intersect_match
+        return intersect_match or set()
+
+
+    def _join_tags(self, match: dict, cache: dict=None):
+        """Return from corpus the position of tokens matching the values
+        of all tags in ``match``
+
+        Tags with a single literal value are looked up as posting lists,
+        which are intersected on sorted positions, starting with the
+        fewest positions. Posting lists thus need not be turned into
+        sets, and compressed posting lists are only decoded in the
+        blocks possibly containing the positions already joined.
+
+        Parameters
+        ----------
+        match : dict
+            A dictionary mapping tags to lists of values, as in
+            ``keyword['match']`` of :meth:`_search_keyword`
+        cache : dict, optional
+            Lookups shared across queries, by default None
+        """
+        matches = []
+        for tag, values in match.items():
+            postings = self._plain_postings(tag, values)
+            if postings is None:
+                matches.append(self._intersect_search(tag, values, cache=cache))
+            else:
+                matches.append(postings)
+        size = lambda m: len(m) if isinstance(m, set) else sum(len(p) for p in m)
+        matches.sort(key=size)
+
+        first = matches[0]
+        if isinstance(first, set):
+            joined = sorted(first)
+        else:
+            joined = [ idx for postings in first for idx in postings ]
+        for m in matches[1:]:
+            if len(joined) == 0:
+                break
+            if isinstance(m, set):
+                joined = [ idx for idx in joined if idx in m ]
+            else:
+                # Index segments hold increasing ranges of positions
+                joined = [ idx for postings in m for idx in intersect(joined, postings) ]
+
+        return set(joined)
+
+
+    def _plain_postings(self, tag:Union[str, int], values:list):
+        """Posting lists, one for each index segment, of a single literal
+        value without flags, or None if ``values`` is anything else
+        """
+        if len(values) != 1 or self._deleted_docs:
+            return None
+        flags, value = value_flags(values[0])
+        value, mode = match_mode(value)
+        if flags or mode != "literal":
+            return None
+        postings = ( index.get(tag, {}).get(value, ()) for index in [self.corp_idx, *self._segments] )
+        return [ p for p in postings if len(p) > 0 ]
+
+
+    def _value_search(self, tag:Union[str, int], value:str, cache: dict=None):
+        """Return from corpus the position of tokens matching a value
+
+        Parameters
+        ----------
+        tag : Union[str, int]
+            The tag of the token used for comparison
+        value : str
+            A literal or regex CQL value
+        cache : dict, optional
+            Lookups shared across queries, by default None
+
+        Returns
+        -------
+        set
+            Positions of the matching tokens. The set may be shared
+            through ``cache`` and must not be modified.
+        """
+        if cache is not None:
+            key = (tag, value)
+            if key in cache:
+                return cache[key]
+
+        matched_indicies = set()
+        flags, value = value_flags(value)
+        value, mode = match_mode(value)
+        if flags:
+            # Exact lookup (or a scan of the smaller folded vocabulary)
+            # in the folded index
+            folded = self._fold_index(tag, flags)
+            if mode == "literal":
+                terms = folded.get(fold_function(flags, self.normalizers)(value), [])
+            else:
+                value = fold_regex(value, fold_function(flags, self.normalizers))
+                pattern = re.compile(append_regex_anchors(value), re.IGNORECASE if 'c' in flags else 0)
+                terms = [ t for k in folded if pattern.search(k) for t in folded[k] ]
+            for term in terms:
+                matched_indicies.update(self._postings(tag, term))
+        elif mode == "literal":
+            matched_indicies.update(self._postings(tag, value))
+        else:
+            pattern = re.compile(append_regex_anchors(value))
+            for term in self._regex_vocabulary(tag, pattern):
+                matched_indicies.update(self._postings(tag, term))
+
+        if cache is not None:
+            cache[key] = matched_indicies
+        return matched_indicies
         
 
 
-    def _get_keywords(self, search_anchor: dict, doc_idx, sent_idx, tk_idx):
-        sent = self._get_corp_data(doc_idx, sent_idx)
-        start_idx = max(0, tk_idx - search_anchor['seed_idx'])
-        end_idx = min(start_idx + search_anchor['length'], len(sent))
+    def _regex_vocabulary(self, tag:Union[str, int], pattern: re.Pattern):
+        """Values of ``tag`` matching ``pattern``, matched in parallel 
+        for large vocabularies (see :meth:`set_regex_parallelism`)
+        """
+        vocab = self.tokens.vocab.get(tag, [None])
+        threshold = self._regex_parallel_threshold
+        if threshold is None or len(vocab) < threshold:
+            return [ term for term in self._vocabulary(tag) if pattern.search(term) ]
+
+        # Imported here, since the pool (and multiprocessing) are only
+        # used with large vocabularies
+        from .regexPool import RegexPool
+        with _regex_pool_lock:
+            pool = self._regex_pool
+            if pool is None or not pool.is_current(self.tokens.vocab):
+                if pool is not None:
+                    pool.shutdown()
+                pool = self._regex_pool = RegexPool(self.tokens.vocab, workers=self._regex_workers)
+            # Held until the match is done, even if the pool is replaced
+            # or shut down by another thread in the meantime
+            pool.acquire()
+        try:
+            return [ vocab[i] for i in pool.match(tag, pattern) ]
+        finally:
+            pool.release()
+
+
+    def _get_keywords(self, search_anchor: dict, position: int, within="s"):
+        # Matches are confined to the sentence (or document) of the seed
+        if within == "s":
+            start, end = self.tokens.sent_bounds(position)
+        else:
+            start, end = self.tokens.doc_bounds_at(position)
+        start_idx = position - search_anchor['seed_idx']
+        end_idx = start_idx + search_anchor['length']
+        if start_idx < start or end_idx > end:
+            return []
         
-        return sent[start_idx:end_idx]
+        return self.tokens.tokens(start_idx, end_idx)
 
 
     def _get_corp_data(self, doc_idx, sent_idx=None, tk_idx=None):
         """Get corpus data by position
         """
-        if self.text_key is not None:
-            if sent_idx is None:
-                return self.corpus[doc_idx][self.text_key]
-            if tk_idx is None:
-                return self.corpus[doc_idx][self.text_key][sent_idx]
-            return self.corpus[doc_idx][self.text_key][sent_idx][tk_idx]
-        else:
-            if sent_idx is None:
-                return self.corpus[doc_idx]
-            if tk_idx is None:
-                return self.corpus[doc_idx][sent_idx]
-            return self.corpus[doc_idx][sent_idx][tk_idx]
+        return self.get_corp_data(doc_idx, sent_idx, tk_idx)
 
 
 ##################
 # Helper functions
 ##################
-def flatten_doc_to_sent(doc):
-    text = []
-    sent_lengths = []
-    for sent in doc:
-        sent_lengths.append(len(sent))
-        text += sent
-
-    def keyword_idx(sent_idx, tk_idx):
-        nonlocal sent_lengths
-        for i in range(sent_idx):
-            tk_idx += sent_lengths[i]
-        return tk_idx
-    
-    return text, keyword_idx
-        
+def keyword_key(keyword: dict):
+    """Hashable representation of the matching conditions of a CQL token
+    """
+    return tuple(
+        tuple(sorted( (tag, tuple(values)) for tag, values in keyword.get(k, {}).items() ))
+        for k in ('match', 'not_match')
+    )
+
 
 def norm_token_struct(token):
     if isinstance(token, dict):
@@ -0,0 +1,124 @@
+import csv
+import json
+from typing import Sequence
+
+EXPORT_FORMATS = ('jsonl', 'json', 'tsv', 'csv')
+
+
+class ConcordanceWriter:
+    """Serialize concordance lines one at a time
+
+    Parameters
+    ----------
+    format : str, optional
+        One of ``"jsonl"``, ``"json"``, ``"tsv"``, or ``"csv"``,
+        by default ``"jsonl"``
+    attrs : Sequence, optional
+        The attributes of the tokens to export, by default None,
+        which exports all attributes
+    labels : Sequence, optional
+        Labels of the CQL capture groups. In ``tsv`` and ``csv``, each
+        label gets its own column, by default ()
+
+    Notes
+    -----
+    The output is :meth:`header`, followed by :meth:`line` of each
+    concordance line, and then :meth:`footer`. In ``tsv`` and ``csv``,
+    the columns are ``doc_idx``, ``sent_idx``, ``tk_idx``, ``left``,
+    ``keyword``, ``right``, and the labels. Tokens are written as
+    their attribute values joined by ``/`` (e.g., ``hits/V``), and
+    separated by spaces.
+    """
+
+    def __init__(self, format="jsonl", attrs: Sequence=None, labels: Sequence=()):
+        if format not in EXPORT_FORMATS:
+            raise ValueError(f"Export format should be one of {EXPORT_FORMATS}, not {format}")
+        self.format = format
+        self.attrs = attrs
+        self.labels = list(labels)
+        self._n_lines = 0
+        if format in ('tsv', 'csv'):
+            self._row = _RowBuffer()
+            self._csv = csv.writer(self._row, dialect='excel-tab' if format == 'tsv' else 'excel')
+
+    def header(self):
+        if self.format == 'json':
+            return '['
+        if self.format == 'jsonl':
+            return ''
+        return self._csv_line(['doc_idx', 'sent_idx', 'tk_idx', 'left', 'keyword', 'right', *self.labels])
+
+    def line(self, concord: dict):
+        self._n_lines += 1
+        if self.format in ('json', 'jsonl'):
+            if self.attrs is not None:
+                concord = {
+                    **concord,
+                    'left': self._keep_attrs(concord['left']),
+                    'keyword': self._keep_attrs(concord['keyword']),
+                    'right': self._keep_attrs(concord['right']),
+                    'captureGroups': {
+                        k: self._keep_attrs(v) for k, v in concord['captureGroups'].items()
+                    }
+                }
+            line = json.dumps(concord, ensure_ascii=False, separators=(',', ':'))
+            if self.format == 'jsonl':
+                return line + '\n'
+            return line if self._n_lines == 1 else ',' + line
+
+        position = concord['position']
+        groups = concord['captureGroups']
+        return self._csv_line([
+            position['doc_idx'], position['sent_idx'], position['tk_idx'],
+            self._join_tokens(concord['left']),
+            self._join_tokens(concord['keyword']),
+            self._join_tokens(concord['right']),
+            *( self._join_tokens(groups.get(label, [])) for label in self.labels )
+        ])
+
+    def footer(self):
+        if self.format == 'json':
+            return ']'
+        return ''
+
+    def _keep_attrs(self, tokens: list):
+        return [ {k: v for k, v in tk.items() if k in self.attrs} for tk in tokens ]
+
+    def _join_tokens(self, tokens: list):
+        joined = []
+        for tk in tokens:
+            if self.attrs is None:
+                values = tk.values()
+            else:
+                values = ( tk[a] for a in self.attrs if a in tk )
+            joined.append('/'.join(str(v) for v in values))
+        return ' '.join(joined)
+
+    def _csv_line(self, row: list):
+        self._csv.writerow(row)
+        return self._row.pop()
+
+
+class _RowBuffer:
+    # File-like object holding the last row written by csv.writer
+    def __init__(self):
+        self.data = []
+
+    def write(self, s):
+        self.data.append(s)
+
+    def pop(self):
+        s = ''.join(self.data)
+        self.data = []
+        return s
+
+
+def query_labels(queries: list):
+    """Labels of the capture groups in parsed CQL queries, in order of appearance
+    """
+    labels = {}
+    for keywords in queries:
+        for keyword in keywords:
+            for label in keyword.get('__label__', []):
+                labels[label] = None
+    return list(labels)
@@ -0,0 +1,304 @@
+import random
+from array import array
+from heapq import merge
+from bisect import bisect_left, bisect_right
+from typing import Iterable
+from .tokenStore import POSITION_TYPE
+from .utils import WITHIN_UNITS
+
+
+class HitSet:
+    """Hits of CQL queries, kept as sorted arrays of token positions
+
+    A hit set is returned by
+    :meth:`~concordancer.concordancer.Concordancer.cql_search` with
+    ``hits=True``. Hits are stored as the positions of their first
+    tokens (``starts``, in increasing order), their lengths, and the
+    queries they match, so hit sets could be combined without building
+    any concordance line:
+
+    .. code-block:: python
+
+        A = C.cql_search('"打" [pos="N.*"]', hits=True)
+        B = C.cql_search('[pos="Neu"]', hits=True)
+        A.not_near(B, 3)           # hits of A not within 3 tokens of B
+        A.in_documents(B.documents())   # hits of A in documents with B
+
+    Set operations (``&``, ``-``, and ``|``) identify hits by their
+    first token, so ``A & B`` are the hits of ``A`` starting where a hit
+    of ``B`` starts. Concordance lines are built only when a hit set is
+    iterated (see :meth:`kwic`).
+    """
+
+    def __init__(self, corpus, starts: array, lengths: array, query_ids: array, queries: list, left=5, right=5):
+        """
+        Parameters
+        ----------
+        corpus : Concordancer
+            The corpus searched
+        starts : array
+            Positions of the first tokens of the hits, in increasing
+            order
+        lengths : array
+            Number of tokens in each hit
+        query_ids : array
+            Indices in ``queries`` of the query matched by each hit
+        queries : list
+            Parsed CQL queries, as returned by
+            :func:`~concordancer.utils.parse_cql`
+        left : int, optional
+            Left context size of the concordance lines, by default 5
+        right : int, optional
+            Right context size of the concordance lines, by default 5
+        """
+        self.corpus = corpus
+        self.starts = starts
+        self.lengths = lengths
+        self.query_ids = query_ids
+        self.queries = queries
+        self.left = left
+        self.right = right
+        self._version = corpus._version
+        self._doc_ids = None
+
+    @classmethod
+    def from_positions(cls, corpus, positions: Iterable, query_ids: Iterable, queries: list, left=5, right=5):
+        """Build a hit set from the positions of hits in any order, and
+        the indices in ``queries`` of the queries they match
+        """
+        hits = sorted( (p, len(queries[q]), q) for p, q in zip(positions, query_ids) )
+        return cls(corpus,
+                   array(POSITION_TYPE, (h[0] for h in hits)),
+                   array(POSITION_TYPE, (h[1] for h in hits)),
+                   array(POSITION_TYPE, (h[2] for h in hits)),
+                   queries, left=left, right=right)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        return self.kwic()
+
+    def __repr__(self):
+        return f"<HitSet: {len(self)} hits of {len(self.queries)} queries>"
+
+    def __and__(self, other):
+        if not isinstance(other, HitSet):
+            return NotImplemented
+        return self.intersection(other)
+
+    def __sub__(self, other):
+        if not isinstance(other, HitSet):
+            return NotImplemented
+        return self.difference(other)
+
+    def __or__(self, other):
+        if not isinstance(other, HitSet):
+            return NotImplemented
+        return self.union(other)
+
+    def kwic(self, left: int=None, right: int=None):
+        """Build the concordance lines of the hits, in the order they
+        appear in the corpus
+
+        Parameters
+        ----------
+        left : int, optional
+            Left context size, by default None, which uses the size the
+            hit set was searched with
+        right : int, optional
+            Right context size, by default None, which uses the size the
+            hit set was searched with
+
+        Yields
+        -------
+        dict
+            A concordance line, as yielded by
+            :meth:`~concordancer.concordancer.Concordancer.cql_search`
+        """
+        self._check_current()
+        left = self.left if left is None else left
+        right = self.right if right is None else right
+        for start, length, query_id in zip(self.starts, self.lengths, self.query_ids):
+            yield self.corpus._kwic_single(start, tk_len=length, left=left, right=right, keywords=self.queries[query_id])
+
+    def positions(self):
+        """Positions of the hits, as the ``position`` of the concordance
+        lines (``{'doc_idx': ..., 'sent_idx': ..., 'tk_idx': ...}``),
+        without building the lines
+        """
+        self._check_current()
+        locate = self.corpus.tokens.locate
+        for start in self.starts:
+            doc_idx, sent_idx, tk_idx = locate(start)
+            yield {'doc_idx': doc_idx, 'sent_idx': sent_idx, 'tk_idx': tk_idx}
+
+    def intersection(self, other: "HitSet"):
+        """Hits starting where a hit of ``other`` starts
+        """
+        self._check_other(other)
+        return self._select(self._common_starts(other, keep=True))
+
+    def difference(self, other: "HitSet"):
+        """Hits not starting where a hit of ``other`` starts
+        """
+        self._check_other(other)
+        return self._select(self._common_starts(other, keep=False))
+
+    def union(self, other: "HitSet"):
+        """Hits of both sets. Hits of ``other`` starting where a hit of
+        this set starts are dropped.
+        """
+        self._check_other(other)
+        offset = len(self.queries)
+        kept = other._select(other._common_starts(self, keep=False))
+        hits = merge(zip(self.starts, self.lengths, self.query_ids),
+                     zip(kept.starts, kept.lengths, ( q + offset for q in kept.query_ids )))
+        starts, lengths, query_ids = array(POSITION_TYPE), array(POSITION_TYPE), array(POSITION_TYPE)
+        for start, length, query_id in hits:
+            starts.append(start)
+            lengths.append(length)
+            query_ids.append(query_id)
+        return HitSet(self.corpus, starts, lengths, query_ids, self.queries + other.queries, left=self.left, right=self.right)
+
+    def near(self, other: "HitSet", distance: int, within="doc"):
+        """Hits with a hit of ``other`` at most ``distance`` tokens away
+
+        Parameters
+        ----------
+        other : HitSet
+            Hits to look for around the hits of this set
+        distance : int
+            Maximum number of tokens between two hits. Hits next to
+            each other, or overlapping, are 0 tokens apart.
+        within : str, optional
+            The structure both hits must be in, ``"doc"`` (the same
+            document, the default) or ``"s"`` (the same sentence)
+        """
+        self._check_other(other)
+        return self._select(self._near(other, distance, within, keep=True))
+
+    def not_near(self, other: "HitSet", distance: int, within="doc"):
+        """Hits without any hit of ``other`` at most ``distance`` tokens
+        away (see :meth:`near`)
+        """
+        self._check_other(other)
+        return self._select(self._near(other, distance, within, keep=False))
+
+    def documents(self):
+        """Indices of the documents with at least one hit, in increasing
+        order
+        """
+        doc_ids = self.doc_ids()
+        return [ d for i, d in enumerate(doc_ids) if i == 0 or d != doc_ids[i - 1] ]
+
+    def doc_counts(self):
+        """Number of hits in each document with at least one hit
+
+        Returns
+        -------
+        dict
+            A map from document indices to numbers of hits
+        """
+        counts = {}
+        for doc_idx in self.doc_ids():
+            counts[doc_idx] = counts.get(doc_idx, 0) + 1
+        return counts
+
+    def in_documents(self, doc_ids: Iterable):
+        """Hits in the documents with the given indices
+        """
+        doc_ids = set(doc_ids)
+        return self._select([ i for i, d in enumerate(self.doc_ids()) if d in doc_ids ])
+
+    def doc_ids(self):
+        """Index of the document of each hit
+
+        Returns
+        -------
+        array
+            Document indices, in the order of the hits (and thus in
+            increasing order)
+        """
+        self._check_current()
+        if self._doc_ids is None:
+            store = self.corpus.tokens
+            doc_ids = array(POSITION_TYPE)
+            doc_idx, doc_end = -1, -1
+            for start in self.starts:
+                # Hits are sorted, so documents are only located when a
+                # hit is past the end of the previous document
+                if start >= doc_end:
+                    doc_idx = store.locate(start)[0]
+                    doc_end = store.doc_bounds(doc_idx)[1]
+                doc_ids.append(doc_idx)
+            self._doc_ids = doc_ids
+        return self._doc_ids
+
+    def sample(self, n: int, seed=None):
+        """A random sample of ``n`` hits
+        """
+        if n >= len(self):
+            return self
+        return self._select(sorted(random.Random(seed).sample(range(len(self)), n)))
+
+    def _select(self, indices: Iterable):
+        """A hit set with the hits at ``indices`` (in increasing order)
+        """
+        indices = list(indices)
+        hits = HitSet(self.corpus,
+                      array(POSITION_TYPE, (self.starts[i] for i in indices)),
+                      array(POSITION_TYPE, (self.lengths[i] for i in indices)),
+                      array(POSITION_TYPE, (self.query_ids[i] for i in indices)),
+                      self.queries, left=self.left, right=self.right)
+        if self._doc_ids is not None:
+            hits._doc_ids = array(POSITION_TYPE, (self._doc_ids[i] for i in indices))
+        return hits
+
+    def _common_starts(self, other: "HitSet", keep: bool):
+        """Indices of the hits starting (or, if not ``keep``, not
+        starting) where a hit of ``other`` starts, found by walking
+        through both sorted arrays of starts
+        """
+        a, b = self.starts, other.starts
+        indices = []
+        j, n = 0, len(b)
+        for i, start in enumerate(a):
+            while j < n and b[j] < start:
+                j += 1
+            if (j < n and b[j] == start) == keep:
+                indices.append(i)
+        return indices
+
+    def _near(self, other: "HitSet", distance: int, within: str, keep: bool):
+        if within not in WITHIN_UNITS:
+            raise ValueError(f"Unknown structure: {within}")
+        store = self.corpus.tokens
+        bounds = store.sent_bounds if WITHIN_UNITS[within] == "s" else store.doc_bounds_at
+        starts, lengths = other.starts, other.lengths
+        max_length = max(lengths, default=0)
+
+        indices = []
+        unit_start, unit_end = -1, -1
+        for i, (start, length) in enumerate(zip(self.starts, self.lengths)):
+            if start >= unit_end:
+                unit_start, unit_end = bounds(start)
+            end = start + length
+            # Hits of ``other`` starting in this window may be close
+            # enough, since no hit is longer than ``max_length``
+            lo = bisect_left(starts, max(start - distance - max_length, unit_start))
+            hi = bisect_right(starts, min(end + distance, unit_end - 1))
+            found = any( starts[j] + lengths[j] + distance >= start for j in range(lo, hi) )
+            if found == keep:
+                indices.append(i)
+        return indices
+
+    def _check_other(self, other: "HitSet"):
+        if other.corpus is not self.corpus:
+            raise ValueError("Hit sets of different corpora cannot be combined")
+        other._check_current()
+        self._check_current()
+
+    def _check_current(self):
+        if self.corpus._version != self._version:
+            raise ValueError("The corpus has changed since the hits were found")
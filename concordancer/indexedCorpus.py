@@ -1,13 +1,26 @@
-import re
-import math
-from typing import Union
-from copy import deepcopy
-from collections import Counter
+import os
+import sys
+import json
+import mmap
+import uuid
+import pathlib
+import contextlib
+from array import array
+from typing import Union, Iterable
+from .tokenStore import TokenStore, POSITION_TYPE, VOCAB_ID_TYPE
+from .utils import DEFAULT_NORMALIZERS, fold_function
+from .postings import PostingsTable, compress, decompress
+
+
+INDEX_FORMAT_VERSION = 1
 
 
 class IndexedCorpus:
 
-    def __init__(self, corpus: list, text_key="text"):
+    _max_segments = 8
+    _compress_min_postings = 128
+
+    def __init__(self, corpus: list, text_key="text", folds: dict=None, normalizers: dict=None, compress_postings=False):
         """Indexing corpus
 
         Parameters
@@ -17,6 +30,30 @@ class IndexedCorpus:
         text_key: str
             The key to where text is stored in a JSON file,
             by default "text"
+        folds : dict, optional
+            Folded indexes to build along with the corpus index, by 
+            default None. Keys are attributes, and values are lists 
+            of CQL flags, e.g., ``{"word": ["c", "cd"]}``. Folded 
+            indexes not built here are built the first time they
+            are needed by a query.
+        normalizers : dict, optional
+            Normalizers of custom CQL flags, by default None. Keys are 
+            the flags (single characters) and values are functions 
+            mapping a string to its normalized form. Flags ``c`` 
+            (lowercase) and ``d`` (strip diacritics and NFKC) are 
+            built in.
+        compress_postings : bool, optional
+            Keep posting lists of the index compressed in memory, by
+            default False. See
+            :class:`~concordancer.postings.CompressedPostings`.
+            Compression takes several times less memory for the
+            postings of frequent values (about 2 bytes per position
+            instead of 8). Joining them with other values (e.g., 
+            ``[word="的" & pos="DE"]``) is as fast as with plain 
+            arrays, or faster for many positions, since only the 
+            blocks that may hold the positions are read. Reading a 
+            whole posting list (e.g., ``[pos="Na"]`` alone) is about
+            1.7 times as slow.
 
         Notes
         -----
@@ -52,54 +89,512 @@ class IndexedCorpus:
                 [...],  # another text
                 ...
             ]
+
+        Values of attributes can be searched with flags in CQL, e.g.,
+        ``[word="the"%c]`` (case-insensitive). Such searches use a folded
+        index of the attribute, which maps normalized values to the 
+        original values, so literal values with flags are looked up
+        without scanning the vocabulary.
+
+        The corpus passed in is neither modified nor referenced after 
+        indexing. Tokens are stored in a columnar 
+        :class:`~concordancer.tokenStore.TokenStore` (``self.tokens``), 
+        and all keys of a text other than ``text_key`` are kept in 
+        ``self.metadata``.
         """
-        self.corpus = corpus
-        self.corp_idx = {}
-        self.all_tk_idx = set()
         self.text_key = text_key
+        self.tokens = TokenStore()
+        self.metadata = []
+        self.corp_idx = {}
+        self._segments = []
+        self._deleted_docs = set()
+        self._version = 0  # Changes whenever search results may change
+        self.normalizers = { **DEFAULT_NORMALIZERS, **(normalizers or {}) }
+        self._fold_idx = {}
+        self.compress_postings = compress_postings
 
         # Detect corpus structure
-        a_token = self.get_corp_data(doc_idx=0, sent_idx=0, tk_idx=0)
-        token_struct = type(a_token)
-        if (token_struct is not dict) and (token_struct is not list) and (token_struct is not str):
-            raise Exception(f"Structure of token in text should be dict, list, or str, not {token_struct}")
-        a_token = norm_token_struct(a_token)
-        for tag in a_token: self.corp_idx[tag] = {}
+        if len(corpus) > 0:
+            a_token = self._doc_text(corpus[0])[0][0]
+            token_struct = type(a_token)
+            if (token_struct is not dict) and (token_struct is not list) and (token_struct is not str):
+                raise Exception(f"Structure of token in text should be dict, list, or str, not {token_struct}")
+            a_token = norm_token_struct(a_token)
+            for tag in a_token: self.corp_idx[tag] = {}
 
         # Index corpus
-        for doc_idx, doc in enumerate(corpus):
-            if self.text_key is not None: enum = doc[text_key]
-            else: enum = doc
-            for sent_idx, sent in enumerate(enum):
-                for tk_idx, token in enumerate(sent):
-                    token = norm_token_struct(token)
-                    for tag, item in token.items():
-                        if item not in self.corp_idx[tag]:
-                            self.corp_idx[tag][item] = []
-                        position = (doc_idx, sent_idx, tk_idx)
-                        self.corp_idx[tag][item].append(position)
-                        self.all_tk_idx.add(position)
-                        
-                        # Update corpus structure
-                        if self.text_key is not None:
-                            self.corpus[doc_idx][self.text_key][sent_idx][tk_idx] = token
-                        else:
-                            self.corpus[doc_idx][sent_idx][tk_idx] = token
+        self._index_documents(self.corp_idx, corpus)
+        self._compress_index()
+        for tag, flags_list in (folds or {}).items():
+            for flags in flags_list:
+                self._fold_index(tag, flags)
+
+
+    @property
+    def all_tk_idx(self):
+        """Positions of all tokens in the corpus, excluding deleted documents
+        """
+        if not self._deleted_docs:
+            return range(len(self.tokens))
+        positions = []
+        for doc_idx in range(self.tokens.n_docs):
+            if doc_idx not in self._deleted_docs:
+                positions.extend(range(*self.tokens.doc_bounds(doc_idx)))
+        return positions
+
+
+    def add_documents(self, documents: Iterable):
+        """Add documents to an indexed corpus
+
+        The new documents are indexed into a separate segment of the 
+        index, so the cost of adding documents is proportional to the 
+        size of the new documents rather than that of the corpus. 
+        Segments are merged into the main index by :meth:`compact`.
+
+        Parameters
+        ----------
+        documents : Iterable
+            Documents structured in the same way as the corpus
+            passed to :meth:`__init__`
+
+        Returns
+        -------
+        list
+            The ``doc_idx`` of the added documents
+        """
+        segment = {}
+        self._make_writable()
+        doc_indices = self._index_documents(segment, documents)
+        self._segments.append(segment)
+        self._version += 1
+
+        # Keep the number of segments to search through bounded
+        if len(self._segments) > self._max_segments:
+            merged = {}
+            for segment in self._segments:
+                _merge_index(merged, segment)
+            self._segments = [merged]
+
+        return doc_indices
+
+
+    def delete_documents(self, doc_ids: Iterable):
+        """Remove documents from an indexed corpus
+
+        Deleted documents are excluded from searches immediately, 
+        but their data are only dropped from the index by 
+        :meth:`compact`. The ``doc_idx`` of the remaining documents
+        are left unchanged.
+
+        Parameters
+        ----------
+        doc_ids : Iterable
+            The ``doc_idx`` of the documents to delete
+        """
+        for doc_idx in doc_ids:
+            if not (0 <= doc_idx < self.tokens.n_docs):
+                raise IndexError(f"Document {doc_idx} not in corpus")
+            self._deleted_docs.add(doc_idx)
+        self._version += 1
+
+
+    def compact(self):
+        """Merge index segments created by :meth:`add_documents` into 
+        the main index and drop the documents deleted by 
+        :meth:`delete_documents`
+        """
+        if self._deleted_docs:
+            # Token positions shift, so the index is built anew
+            self.tokens.drop_documents(self._deleted_docs)
+            for doc_idx in self._deleted_docs:
+                self.metadata[doc_idx] = None
+            self.corp_idx = {}
+            self._index_positions(self.corp_idx, range(len(self.tokens)))
+            self._version += 1
+        else:
+            for segment in self._segments:
+                _merge_index(self.corp_idx, segment)
+        self._segments = []
+        self._deleted_docs = set()
+        self._compress_index()
+
+
+    def save(self, path: str):
+        """Save the indexed corpus to a directory
+
+        Pending segments and deletions are merged into the main 
+        index (see :meth:`compact`) before saving.
+
+        Each file is written to a temporary file in the directory,
+        which then replaces the file, and ``meta.json`` is written
+        last. Files mapped by processes that loaded the corpus with
+        ``load(mmap=True)`` are thus never changed in place, and
+        these processes keep reading the previous index.
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory, which is created if it does not exist
+        """
+        # compact() modifies the data, which may be mapped from files
+        self._make_writable()
+        self.compact()
+        path = pathlib.Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        store = self.tokens
+
+        meta = {
+            'format_version': INDEX_FORMAT_VERSION,
+            'byteorder': sys.byteorder,
+            'typecodes': { 'vocab_id': [VOCAB_ID_TYPE, array(VOCAB_ID_TYPE).itemsize], 
+                           'position': [POSITION_TYPE, array(POSITION_TYPE).itemsize] },
+            'text_key': self.text_key,
+            'attrs': store.attrs,
+            **self._extra_meta()
+        }
+        with _replace_file(path / 'vocab.json', 'w') as f:
+            json.dump([ store.vocab[attr] for attr in store.attrs ], f, ensure_ascii=False)
+        with _replace_file(path / 'metadata.jsonl', 'w') as f:
+            for doc_meta in self.metadata:
+                f.write(json.dumps(doc_meta, ensure_ascii=False) + '\n')
+
+        _write_array(path / 'sent_offsets.bin', store.sent_offsets)
+        _write_array(path / 'doc_offsets.bin', store.doc_offsets)
+        for i, attr in enumerate(store.attrs):
+            _write_array(path / f'column.{i}.bin', store.columns[attr])
+            # Postings of all values, ordered by vocabulary id
+            postings = self.corp_idx.get(attr, {})
+            offsets = array(POSITION_TYPE, [0])
+            with _replace_file(path / f'postings.{i}.bin', 'wb') as f:
+                for value in store.vocab[attr][1:]:
+                    positions = postings.get(value, ())
+                    if len(positions) > 0:
+                        f.write(bytes(decompress(positions)))
+                    offsets.append(offsets[-1] + len(positions))
+            _write_array(path / f'postings.{i}.offsets.bin', offsets)
+        # Written last, so that a complete index has a meta.json
+        with _replace_file(path / 'meta.json', 'w') as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+
+    @classmethod
+    def load(cls, path: str, normalizers: dict=None, compress_postings=False, mmap=False):
+        """Load an indexed corpus saved by :meth:`save`
+
+        Parameters
+        ----------
+        path : str
+            Path to the directory of the saved corpus
+        normalizers : dict, optional
+            Normalizers of custom CQL flags, by default None. 
+            See :meth:`__init__`.
+        compress_postings : bool, optional
+            Keep posting lists compressed in memory, by default False.
+            See :meth:`__init__`.
+        mmap : bool, optional
+            Map the token columns and the posting lists from the saved
+            files into memory instead of reading them, by default False.
+            The mapped data are read-only and are shared by all processes
+            mapping the same files (e.g., the workers of a pre-fork 
+            server loading the corpus before or after forking), so that 
+            they take the memory of a single copy of the corpus. Only 
+            the vocabularies and the metadata are loaded into each 
+            process. The data are copied into the process the first
+            time documents are added to the corpus. Since :meth:`save`
+            replaces the files instead of overwriting them, a process
+            mapping a corpus keeps seeing the index it loaded, even if
+            the corpus is saved again to the same directory, until it
+            loads the corpus again.
+
+        Returns
+        -------
+        IndexedCorpus
+            The loaded corpus
+        """
+        path = pathlib.Path(path)
+        with open(path / 'meta.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['format_version'] != INDEX_FORMAT_VERSION:
+            raise ValueError(f"Index format version {meta['format_version']} is not supported")
+        if meta['byteorder'] != sys.byteorder or \
+            meta['typecodes']['vocab_id'][1] != array(VOCAB_ID_TYPE).itemsize or \
+            meta['typecodes']['position'][1] != array(POSITION_TYPE).itemsize:
+            raise ValueError("Index saved on an incompatible platform")
+
+        if compress_postings and mmap:
+            raise ValueError("Posting lists of a memory-mapped corpus cannot be compressed")
+
+        self = cls.__new__(cls)
+        self.text_key = meta['text_key']
+        self.corp_idx = {}
+        self._segments = []
+        self._deleted_docs = set()
+        self._version = 0
+        self.normalizers = { **DEFAULT_NORMALIZERS, **(normalizers or {}) }
+        self._fold_idx = {}
+        self.compress_postings = compress_postings
+        self._restore_meta(meta)
+        with open(path / 'metadata.jsonl', encoding='utf-8') as f:
+            self.metadata = [ json.loads(l) for l in f ]
+
+        store = self.tokens = TokenStore()
+        with open(path / 'vocab.json', encoding='utf-8') as f:
+            vocab = json.load(f)
+        read = _map_array if mmap else _read_array
+        store.sent_offsets = read(path / 'sent_offsets.bin', POSITION_TYPE)
+        store.doc_offsets = read(path / 'doc_offsets.bin', POSITION_TYPE)
+        for i, attr in enumerate(meta['attrs']):
+            store.attrs.append(attr)
+            store.vocab[attr] = vocab[i]
+            store.vocab_ids[attr] = { v:j for j, v in enumerate(vocab[i]) if j > 0 }
+            store.columns[attr] = read(path / f'column.{i}.bin', VOCAB_ID_TYPE)
+            positions = read(path / f'postings.{i}.bin', POSITION_TYPE)
+            offsets = read(path / f'postings.{i}.offsets.bin', POSITION_TYPE)
+            if mmap:
+                self.corp_idx[attr] = PostingsTable(store.vocab[attr], store.vocab_ids[attr], positions, offsets)
+                continue
+            postings = self.corp_idx[attr] = {}
+            for j, value in enumerate(vocab[i][1:]):
+                if offsets[j + 1] > offsets[j]:
+                    postings[value] = positions[offsets[j]:offsets[j + 1]]
+        self._compress_index()
+
+        return self
+
+
+    def memory_usage(self):
+        """Approximate memory taken by the token store and the index, in bytes
+        """
+        store = self.tokens
+        size = 0
+        arrays = [ store.sent_offsets, store.doc_offsets, *store.columns.values() ]
+        for index in [self.corp_idx, *self._segments]:
+            for postings in index.values():
+                size += sys.getsizeof(postings)
+                if isinstance(postings, PostingsTable):
+                    arrays.append(postings)
+                else:
+                    arrays.extend(postings.values())
+        size += sum( _nbytes(a) for a in arrays )
+        for attr in store.attrs:
+            size += sys.getsizeof(store.vocab[attr]) + sys.getsizeof(store.vocab_ids[attr])
+            size += sum( sys.getsizeof(v) for v in store.vocab[attr] )
+        return size
+
+
+    def _make_writable(self):
+        """Copy the data mapped from files by :meth:`load` into memory
+        """
+        store = self.tokens
+        store.sent_offsets = _copy_array(store.sent_offsets, POSITION_TYPE)
+        store.doc_offsets = _copy_array(store.doc_offsets, POSITION_TYPE)
+        for attr in store.attrs:
+            store.columns[attr] = _copy_array(store.columns[attr], VOCAB_ID_TYPE)
+        for tag, postings in self.corp_idx.items():
+            if isinstance(postings, PostingsTable):
+                self.corp_idx[tag] = { value: decompress(postings[value]) for value in postings }
+
+
+    def _compress_index(self):
+        if not self.compress_postings:
+            return
+        for postings in self.corp_idx.values():
+            for value, positions in postings.items():
+                postings[value] = compress(positions, min_size=self._compress_min_postings)
+
+
+    def _extra_meta(self):
+        return {}
+
+
+    def _restore_meta(self, meta: dict):
+        pass
 
 
     def get_corp_data(self, doc_idx, sent_idx=None, tk_idx=None):
+        """Get the tokens of a document, a sentence, or a single token
+
+        Parameters
+        ----------
+        doc_idx : int
+            Index of the document
+        sent_idx : int, optional
+            Index of the sentence in the document, by default None,
+            which returns all sentences in the document
+        tk_idx : int, optional
+            Index of the token in the sentence, by default None,
+            which returns all tokens in the sentence
+
+        Returns
+        -------
+        Union[list, dict]
+            A list of sentences (lists of tokens), a list of tokens, 
+            or a token. Tokens are built as dictionaries on every call,
+            so modifying them does not affect the corpus.
+        """
+        store = self.tokens
+        n_sents = store.doc_sentences(doc_idx)
+        if sent_idx is None:
+            return [ self.get_corp_data(doc_idx, i) for i in range(n_sents) ]
+        if not (0 <= sent_idx < n_sents):
+            raise IndexError(f"Sentence {sent_idx} not in document {doc_idx}")
+        start = store.position(doc_idx, sent_idx)
+        end = store.position(doc_idx, sent_idx + 1)
+        if tk_idx is None:
+            return store.tokens(start, end)
+        if not (0 <= tk_idx < end - start):
+            raise IndexError(f"Token {tk_idx} not in sentence {sent_idx} of document {doc_idx}")
+        return store.token(start + tk_idx)
+
+
+    def _doc_text(self, doc):
         if self.text_key is not None:
-            if sent_idx is None:
-                return self.corpus[doc_idx][self.text_key]
-            if tk_idx is None:
-                return self.corpus[doc_idx][self.text_key][sent_idx]
-            return self.corpus[doc_idx][self.text_key][sent_idx][tk_idx]
-        else:
-            if sent_idx is None:
-                return self.corpus[doc_idx]
-            if tk_idx is None:
-                return self.corpus[doc_idx][sent_idx]
-            return self.corpus[doc_idx][sent_idx][tk_idx]
+            return doc[self.text_key]
+        return doc
+
+
+    def _index_documents(self, index: dict, documents: Iterable):
+        doc_indices = []
+        for doc in documents:
+            doc_indices.append(self.tokens.n_docs)
+            if self.text_key is not None:
+                self.metadata.append({ k:v for k, v in doc.items() if k != self.text_key })
+            else:
+                self.metadata.append(None)
+            sents = ( (norm_token_struct(tk) for tk in sent) for sent in self._doc_text(doc) )
+            positions = self.tokens.append_document(sents)
+            self._index_positions(index, positions)
+        return doc_indices
+
+
+    def _index_positions(self, index: dict, positions: range):
+        store = self.tokens
+        for tag in store.attrs:
+            if tag not in index:
+                index[tag] = {}
+            postings = index[tag]
+            column = store.columns[tag]
+            vocab = store.vocab[tag]
+            for position in positions:
+                vocab_id = column[position]
+                if vocab_id == 0: continue
+                item = vocab[vocab_id]
+                if item not in postings:
+                    postings[item] = array(POSITION_TYPE)
+                postings[item].append(position)
+
+
+    def _postings(self, tag: Union[str, int], value):
+        """Positions of the tokens with ``value`` as their ``tag``, 
+        excluding deleted documents
+        """
+        for index in [self.corp_idx, *self._segments]:
+            positions = index.get(tag, {}).get(value, ())
+            if self._deleted_docs:
+                positions = [ p for p in positions if not self._is_deleted(p) ]
+            yield from positions
+
+
+    def _vocabulary(self, tag: Union[str, int]):
+        """Distinct values of ``tag`` in the corpus
+        """
+        vocab = self.corp_idx.get(tag, {})
+        yield from vocab
+        seen = set()
+        for segment in self._segments:
+            for value in segment.get(tag, {}):
+                if value not in vocab and value not in seen:
+                    seen.add(value)
+                    yield value
+
+
+    def _fold_index(self, tag: Union[str, int], flags: str):
+        """Map the normalized values of ``tag`` to their original values
+
+        The map is kept up to date with the vocabulary, which only 
+        grows, by folding values added since it was last used.
+        """
+        flags = ''.join(sorted(set(flags)))
+        key = (tag, flags)
+        if key not in self._fold_idx:
+            self._fold_idx[key] = [{}, 1]  # map, vocabulary ids folded so far
+        folded, n = self._fold_idx[key]
+        vocab = self.tokens.vocab.get(tag, [None])
+        if n < len(vocab):
+            fold = fold_function(flags, self.normalizers)
+            for value in vocab[n:]:
+                if not isinstance(value, str): continue
+                folded_value = fold(value)
+                if folded_value not in folded:
+                    folded[folded_value] = []
+                folded[folded_value].append(value)
+            self._fold_idx[key][1] = len(vocab)
+        return folded
+
+
+    def _is_deleted(self, position: int):
+        return self.tokens.locate(position)[0] in self._deleted_docs
+
+
+def _write_array(path, a: array):
+    with _replace_file(path, 'wb') as f:
+        a.tofile(f)
+
+
+@contextlib.contextmanager
+def _replace_file(path, mode: str):
+    # Write to a temporary file in the same directory, and replace
+    # ``path`` with it once it is complete. The file previously at
+    # ``path`` is unlinked, not truncated, so mappings of it stay valid.
+    path = pathlib.Path(path)
+    tmp_path = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    try:
+        with open(tmp_path, 'x' + mode.replace('w', ''), encoding=None if 'b' in mode else 'utf-8') as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _read_array(path, typecode: str):
+    a = array(typecode)
+    with open(path, 'rb') as f:
+        a.frombytes(f.read())
+    return a
+
+
+def _map_array(path, typecode: str):
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return array(typecode)
+        # The view keeps the mapping open after the file is closed
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(typecode)
+
+
+def _copy_array(a, typecode: str):
+    if not isinstance(a, memoryview):
+        return a
+    copy = array(typecode)
+    copy.frombytes(a.cast('B'))
+    return copy
+
+
+def _nbytes(a):
+    if hasattr(a, 'nbytes'):
+        return a.nbytes
+    return a.itemsize * len(a)
+
+
+def _merge_index(target: dict, source: dict):
+    # Positions in ``source`` come after those in ``target``
+    for tag, values in source.items():
+        if tag not in target:
+            target[tag] = {}
+        for value, positions in values.items():
+            if value not in target[tag]:
+                target[tag][value] = array(POSITION_TYPE)
+            target[tag][value].extend(positions)
 
 
 def norm_token_struct(token):
@@ -1,101 +1,182 @@
-from copy import deepcopy
-from tabulate import tabulate
+import shutil
+import unicodedata
+from itertools import islice
 from typing import Union, Sequence, Generator
 
 class KWIC:
     """Printing concordance data in keyword-in-context format
     """
 
-    def __init__(self, concordance:Union[Sequence, Generator]):
+    def __init__(self, concordance:Union[Sequence, Generator], attrs=['word', 'pos'], page_size=30, width=None, show=True):
         """Initialize a concordance list as KWIC and print it out
 
+        Concordance lines are consumed lazily and printed in pages,
+        so a generator of a large number of results (e.g., returned
+        by :meth:`~concordancer.concordancer.Concordancer.cql_search`)
+        can be printed without first being converted to a list.
+
         Parameters
         ----------
+        concordance : Union[Sequence, Generator]
+            Concordance lines
         attrs : list, optional
-            The attributes of a token to include in printing, 
+            The attributes of a token to include in printing,
             by default ['word', 'pos']
-        print_idx : Sequence[int], optional
-            Indicies of the instances of the concordance list 
-            to print out, by default None. If None, all instances 
-            are printed out.
+        page_size : int, optional
+            Number of concordance lines in a page, by default 30.
+            Columns are aligned within each page.
+        width : int, optional
+            Maximum width of a printed line, by default None, which
+            uses the width of the terminal. The left and right contexts
+            are truncated to fit in.
+        show : bool, optional
+            Print out all pages right away, by default True. If False,
+            pages could be printed one at a time with :meth:`next_page`.
         """
         self.data = concordance
-        self.print_keys = ['left', 'keyword', 'right', 'captureGroups']
-        self.captureGroup_keys = set()
-        self.print()
-    
+        self.attrs = attrs
+        self.page_size = page_size
+        self.width = width
+        self._lines = None
+        if show:
+            self.print()
+
     def __str__(self):
-        return self.data
-    
-    def print(self, attrs=['word', 'pos']):
+        return '\n\n'.join(self.pages())
+
+    def print(self, attrs=None):
         """Pretty print a concordance list
 
         Parameters
         ----------
         attrs : list, optional
-            The attributes of a token to include in printing, 
-            by default ['word', 'pos']
-        print_idx : Sequence[int], optional
-            Indicies of the instances of the concordance list 
-            to print out, by default None. If None, all instances 
-            are printed out.
+            The attributes of a token to include in printing,
+            by default None, which uses the attributes given
+            when initializing
         """
-        print_data = []
-        for concord in self.data:
-            concord = _keep_dict_keys(deepcopy(concord), self.print_keys)
+        for i, page in enumerate(self.pages(attrs)):
+            if i > 0: print()
+            print(page)
 
-            if 'captureGroups' in concord:
-                for label, tokens in concord.get('captureGroups').items():
-                    label = f"LABEL: {label}"
-                    concord[label] = tokens
-                    self.captureGroup_keys.add(label)
-                del concord['captureGroups']
+    def next_page(self, attrs=None):
+        """Print the next page of the concordance lines
 
-            # Add captureGroup keys to print keys
-            for k in self.captureGroup_keys:
-                if k not in self.print_keys:
-                    self.print_keys.append(k)
-
-            # Separate word/tag
-            concord = self._separate_attrs(concord, attrs)
-            print_data.append(concord)
-        
-        print(tabulate(print_data, headers="keys"))
+        Parameters
+        ----------
+        attrs : list, optional
+            The attributes of a token to include in printing,
+            by default None, which uses the attributes given
+            when initializing
 
+        Returns
+        -------
+        bool
+            False if there are no more concordance lines, else True
+        """
+        if self._lines is None:
+            self._lines = iter(self.data)
+        lines = list(islice(self._lines, self.page_size))
+        if len(lines) == 0:
+            return False
+        print(self._render_page(lines, attrs or self.attrs))
+        return True
 
-    def _separate_attrs(self, concord: dict, attrs: list):
-        """Paste multiple attributes of a token together for printing
+    def pages(self, attrs=None):
+        """Render the concordance lines page by page
 
         Parameters
         ----------
-        concord : dict
-            A concordance object
-        attrs : list
-            Names of attributes to paste together
+        attrs : list, optional
+            The attributes of a token to include in printing,
+            by default None, which uses the attributes given
+            when initializing
 
-        Returns
+        Yields
         -------
-        dict
-            An concordance object with lists replaced with string 
-            for printing
+        str
+            A rendered page
         """
-        for key in self.print_keys:
-            if key == 'captureGroups': continue
-            tokens = []
-            for token in concord[key]:
-                concat_val = []
-                for attr, val in token.items():
-                    if attr in attrs:
-                        concat_val.append(val)
-                concat_val = '/'.join(concat_val)
-                tokens.append(concat_val)
-            concord[key] = ' '.join(tokens)
-                            
-        return concord
-
-
-def _keep_dict_keys(dict_, keys):
-    for k in deepcopy(dict_):
-        if k not in keys:
-            del dict_[k]
-    return dict_
+        lines = iter(self.data)
+        while True:
+            page = list(islice(lines, self.page_size))
+            if len(page) == 0:
+                return
+            yield self._render_page(page, attrs or self.attrs)
+
+    def _render_page(self, concord_list: list, attrs: list):
+        # Capture groups found in this page
+        labels = {}
+        for concord in concord_list:
+            for label in concord.get('captureGroups', {}):
+                labels[label] = None
+
+        headers = ['left', 'keyword', 'right', *( f"LABEL: {lab}" for lab in labels )]
+        rows = []
+        for concord in concord_list:
+            groups = concord.get('captureGroups', {})
+            rows.append([
+                _join_tokens(concord['left'], attrs),
+                _join_tokens(concord['keyword'], attrs),
+                _join_tokens(concord['right'], attrs),
+                *( _join_tokens(groups.get(lab, []), attrs) for lab in labels )
+            ])
+
+        # Column widths of this page
+        widths = [ max(display_width(r[i]) for r in [headers] + rows) for i in range(len(headers)) ]
+        width = self.width or shutil.get_terminal_size().columns
+        fixed = sum(widths[1:2] + widths[3:]) + 2 * (len(headers) - 1)
+        context_width = max(10, (width - fixed) // 2)
+        widths[0] = min(widths[0], context_width)
+        widths[2] = min(widths[2], context_width)
+
+        out = []
+        out.append('  '.join(pad(h, w) for h, w in zip(headers, widths)).rstrip())
+        out.append('  '.join('-' * w for w in widths))
+        for row in rows:
+            cells = [ pad(truncate(row[0], widths[0], keep_end=True), widths[0], align_right=True) ]
+            cells += [ pad(truncate(cell, w), w) for cell, w in zip(row[1:], widths[1:]) ]
+            out.append('  '.join(cells).rstrip())
+
+        return '\n'.join(out)
+
+
+def _join_tokens(tokens: list, attrs: list):
+    """Paste multiple attributes of tokens together for printing
+    """
+    joined = []
+    for token in tokens:
+        joined.append('/'.join( str(val) for attr, val in token.items() if attr in attrs ))
+    return ' '.join(joined)
+
+
+def display_width(s: str):
+    """Number of terminal cells taken by a string, counting East Asian
+    wide characters as two cells
+    """
+    width = 0
+    for ch in s:
+        if unicodedata.combining(ch):
+            continue
+        width += 2 if unicodedata.east_asian_width(ch) in ('W', 'F') else 1
+    return width
+
+
+def truncate(s: str, width: int, keep_end=False):
+    """Truncate a string to a display width, marking the cut with ``…``
+    """
+    if display_width(s) <= width:
+        return s
+    chars = reversed(s) if keep_end else s
+    kept, w = [], 1
+    for ch in chars:
+        w += display_width(ch)
+        if w > width: break
+        kept.append(ch)
+    if keep_end:
+        return '…' + ''.join(reversed(kept))
+    return ''.join(kept) + '…'
+
+
+def pad(s: str, width: int, align_right=False):
+    space = ' ' * (width - display_width(s))
+    return space + s if align_right else s + space
@@ -0,0 +1,436 @@
+"""Load testing of the query server
+
+Starts :func:`~concordancer.server.run` on a saved corpus in a separate
+process, replays CQL queries against its ``/query`` endpoint from
+concurrent clients, and reports throughput, latency percentiles, error
+rates, and the memory (RSS) of the server process over time.
+
+Run from the command line with, e.g.::
+
+    python -m concordancer.loadtest corpus_index/ --queries queries.txt \\
+        --concurrency 8 --rate 20 --duration 60 --output results.json
+"""
+import os
+import sys
+import json
+import math
+import time
+import socket
+import random
+import argparse
+import platform
+import threading
+import tempfile
+import subprocess
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+from .server import URL_ESCAPES
+
+
+SERVER_SCRIPT = """
+import sys
+from concordancer.concordancer import Concordancer
+from concordancer.server import run
+run(Concordancer.load(sys.argv[1]), port=int(sys.argv[2]), open_browser=False)
+"""
+
+
+def load_test(index: str, queries: list, concurrency=4, rate: float=None, n_requests: int=None,
+              duration: float=None, left=5, right=5, format="compact", port: int=None,
+              sample_interval=1.0, timeout=60, output: str=None):
+    """Replay queries against a locally started query server
+
+    Parameters
+    ----------
+    index : str
+        Directory of a corpus saved by
+        :meth:`~concordancer.indexedCorpus.IndexedCorpus.save`, which
+        is served by :func:`~concordancer.server.run` in a new process
+    queries : list
+        CQL queries to send, e.g., read from a query log with
+        :func:`read_query_log` or generated by :func:`synthetic_queries`.
+        Queries are sent in the order given, starting over from the
+        first one when all have been sent.
+    concurrency : int, optional
+        Number of clients sending requests at the same time, by default 4
+    rate : float, optional
+        Requests sent per second, by default None, which sends a new
+        request as soon as a client is free. With a rate, requests are
+        scheduled at fixed intervals, and the latency of a request is
+        measured from its scheduled time, so that the time requests
+        wait for a free client is counted as well.
+    n_requests : int, optional
+        Number of requests to send, by default None, which sends each
+        query once (if ``duration`` is not given either)
+    duration : float, optional
+        Stop sending requests after ``duration`` seconds, by default None
+    left : int, optional
+        Left context size of the queries, by default 5
+    right : int, optional
+        Right context size of the queries, by default 5
+    format : str, optional
+        Format of the responses, ``compact`` (as requested by the
+        query interface) or ``json``, by default ``compact``
+    port : int, optional
+        The port the server listens on, by default None, which uses a
+        free port
+    sample_interval : float, optional
+        Seconds between samples of the server's memory and between the
+        points of the reported timeline, by default 1.0
+    timeout : float, optional
+        Seconds before a request is given up as an error, by default 60
+    output : str, optional
+        Path to save the report as JSON, by default None
+
+    Returns
+    -------
+    dict
+        The report, with the keys ``config``, ``summary`` (counts,
+        throughput, latency percentiles in seconds, and error rate of
+        all requests), ``timeline`` (the same measures for every
+        ``sample_interval`` seconds, along with the server's RSS in
+        bytes), ``errors`` (counts of error messages), and ``slowest``
+        (the queries with the highest latencies)
+
+    Notes
+    -----
+    The server caches the responses of recent queries, so a query log
+    with repeated queries measures the cache as well, as in real use.
+    The RSS of the server is read from ``/proc`` and is only available
+    on Linux, unless ``psutil`` is installed.
+    """
+    if n_requests is None and duration is None:
+        n_requests = len(queries)
+    config = {
+        'index': str(index), 'n_queries': len(queries), 'concurrency': concurrency,
+        'rate': rate, 'n_requests': n_requests, 'duration': duration, 'left': left,
+        'right': right, 'format': format, 'python': platform.python_version(),
+        'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    if port is None:
+        port = _free_port()
+    server = start_server(index, port, timeout=timeout)
+    try:
+        rss = []
+        stop = threading.Event()
+        sampler = threading.Thread(target=_sample_rss, args=(server.pid, sample_interval, rss, stop), daemon=True)
+        sampler.start()
+        records = _send_requests(f"http://localhost:{port}/query", queries, concurrency, rate,
+                                 n_requests, duration, left, right, format, timeout)
+        stop.set()
+        sampler.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    report = build_report(records, rss, sample_interval)
+    report = { 'config': config, **report }
+    if output is not None:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def start_server(index: str, port: int, timeout=60):
+    """Start :func:`~concordancer.server.run` on a saved corpus in a new
+    process, and wait until it answers queries
+
+    Returns
+    -------
+    subprocess.Popen
+        The server process
+
+    Raises
+    ------
+    RuntimeError
+        If ``port`` is already in use, or if the server exits or does
+        not answer a query within ``timeout`` seconds
+    """
+    # Otherwise, another server on the port would be load-tested
+    if not _port_free(port):
+        raise RuntimeError(f"Port {port} is already in use")
+    # Make this copy of the package importable in the server process
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    # The server logs every request to stderr, which is only shown if it fails to start
+    log = tempfile.TemporaryFile()
+    server = subprocess.Popen([sys.executable, '-c', SERVER_SCRIPT, str(index), str(port)],
+                              stdout=subprocess.DEVNULL, stderr=log, env=env)
+    deadline = time.monotonic() + timeout
+    while True:
+        if server.poll() is not None:
+            log.seek(0)
+            raise RuntimeError(f"Server exited with code {server.returncode}:\n" +
+                               log.read().decode('utf-8', errors='replace'))
+        # The process started must be the one answering
+        if _probe(port) and server.poll() is None:
+            return server
+        if time.monotonic() > deadline:
+            server.terminate()
+            raise RuntimeError(f"Server not started in {timeout} seconds")
+        time.sleep(0.1)
+
+
+def read_query_log(path: str):
+    """Read CQL queries from a file, one query per line. Empty lines
+    and lines starting with ``#`` are skipped.
+    """
+    with open(path, encoding='utf-8') as f:
+        return [ l.strip() for l in f if l.strip() and not l.startswith('#') ]
+
+
+def synthetic_queries(index: str, n=100, seed=None):
+    """Generate a mix of CQL queries from the tokens of a saved corpus
+
+    Tokens are drawn at random positions of the corpus, so values are
+    picked as often as they occur. The mix includes single words,
+    sequences of words and tags, gaps, and regular expressions.
+
+    Parameters
+    ----------
+    index : str
+        Directory of a corpus saved by
+        :meth:`~concordancer.indexedCorpus.IndexedCorpus.save`
+    n : int, optional
+        Number of queries, by default 100
+    seed : optional
+        Seed of the random generator, by default None
+
+    Returns
+    -------
+    list
+        CQL queries
+    """
+    from .concordancer import Concordancer
+    C = Concordancer.load(index)
+    store = C.tokens
+    rng = random.Random(seed)
+    attr = C._cql_default_attr if C._cql_default_attr in store.attrs else store.attrs[0]
+    tag = next(( a for a in store.attrs if a != attr and isinstance(a, str) ), None)
+
+    def value(a, position):
+        v = store.value(a, position)
+        return None if v is None else str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+    templates = [
+        lambda w, t, w2, t2: f'"{w}"',
+        lambda w, t, w2, t2: f'"{w}" "{w2}"',
+        lambda w, t, w2, t2: f'"{w}" []{{1,2}} "{w2}"',
+    ]
+    if tag is not None:
+        templates += [
+            lambda w, t, w2, t2: f'"{w}" [{tag}="{t2}"]',
+            lambda w, t, w2, t2: f'[{attr}="{w}" & {tag}="{t}"]',
+            lambda w, t, w2, t2: f'[{tag}="{t[:1]}.*"] "{w2}"' if t[:1].isalnum() else f'"{w2}"',
+        ]
+
+    queries = []
+    while len(queries) < n and len(store) > 1:
+        position = rng.randrange(len(store) - 1)
+        w, w2 = value(attr, position), value(attr, position + 1)
+        t, t2 = (value(tag, position), value(tag, position + 1)) if tag is not None else ('', '')
+        if None in (w, w2, t, t2):
+            continue
+        queries.append(rng.choice(templates)(w, t, w2, t2))
+    return queries
+
+
+def build_report(records: list, rss: list, interval=1.0):
+    """Summarize the records of requests sent by :func:`load_test`
+    """
+    report = { 'summary': _summarize(records), 'timeline': [], 'errors': {}, 'slowest': [] }
+    report['summary']['max_rss'] = max(( m for t, m in rss ), default=None)
+    if len(records) == 0:
+        return report
+
+    end = max( r['start'] + r['latency'] for r in records )
+    for i in range(int(end // interval) + 1):
+        t0, t1 = i * interval, (i + 1) * interval
+        # Requests are counted in the interval they finish
+        point = _summarize([ r for r in records if t0 <= r['start'] + r['latency'] < t1 ], interval)
+        samples = [ m for t, m in rss if t0 <= t < t1 ]
+        point = { 'time': t1, 'rss': max(samples) if samples else None, **point }
+        report['timeline'].append(point)
+
+    report['errors'] = dict(Counter( r['error'] for r in records if r['error'] is not None ))
+    slowest = sorted(records, key=lambda r: r['latency'], reverse=True)[:10]
+    report['slowest'] = [ { 'query': r['query'], 'latency': r['latency'], 'status': r['status'] } for r in slowest ]
+    return report
+
+
+def percentile(values: list, q: float):
+    """The ``q``-th percentile (0-100) of sorted values, by nearest rank
+    """
+    if len(values) == 0:
+        return None
+    rank = min(len(values), max(1, math.ceil(q / 100 * len(values))))
+    return values[rank - 1]
+
+
+def _summarize(records: list, duration: float=None):
+    latencies = sorted( r['latency'] for r in records )
+    n_errors = sum( r['error'] is not None for r in records )
+    if duration is None:
+        duration = max(( r['start'] + r['latency'] for r in records ), default=0)
+    return {
+        'requests': len(records),
+        'errors': n_errors,
+        'error_rate': n_errors / len(records) if records else None,
+        'throughput': len(records) / duration if duration else None,
+        'bytes': sum( r['bytes'] for r in records ),
+        'latency': {
+            'mean': sum(latencies) / len(latencies) if latencies else None,
+            'p50': percentile(latencies, 50),
+            'p90': percentile(latencies, 90),
+            'p95': percentile(latencies, 95),
+            'p99': percentile(latencies, 99),
+            'max': latencies[-1] if latencies else None,
+        },
+        'status': dict(Counter( str(r['status']) for r in records )),
+    }
+
+
+def _send_requests(url, queries, concurrency, rate, n_requests, duration, left, right, format, timeout):
+    records = []
+    lock = threading.Lock()
+    counter = iter(range(sys.maxsize))
+    start = time.monotonic()
+
+    def client():
+        while True:
+            with lock:
+                i = next(counter)
+            if n_requests is not None and i >= n_requests:
+                return
+            scheduled = start + i / rate if rate else time.monotonic()
+            if duration is not None and scheduled - start >= duration:
+                return
+            delay = scheduled - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            cql = queries[i % len(queries)]
+            record = { 'query': cql, 'start': scheduled - start, 'status': None, 'bytes': 0, 'error': None }
+            try:
+                with urllib.request.urlopen(_query_url(url, cql, left, right, format), timeout=timeout) as resp:
+                    record['bytes'] = len(resp.read())
+                    record['status'] = resp.status
+            except urllib.error.HTTPError as e:
+                record['status'] = e.code
+                record['error'] = f"HTTP {e.code}"
+            except Exception as e:
+                record['error'] = type(e).__name__
+            record['latency'] = time.monotonic() - scheduled
+            with lock:
+                records.append(record)
+
+    clients = [ threading.Thread(target=client, daemon=True) for _ in range(concurrency) ]
+    for c in clients: c.start()
+    for c in clients: c.join()
+    return records
+
+
+def _query_url(url, cql, left, right, format):
+    # Escape CQL in the same way as the query interface
+    for char, escape in URL_ESCAPES:
+        cql = cql.replace(char, escape)
+    params = urllib.parse.urlencode({ 'query': cql, 'left': left, 'right': right, 'format': format })
+    return f"{url}?{params}"
+
+
+def _free_port():
+    with socket.socket() as s:
+        s.bind(('localhost', 0))
+        return s.getsockname()[1]
+
+
+def _port_free(port):
+    with socket.socket() as s:
+        try:
+            s.bind(('localhost', port))
+            return True
+        except OSError:
+            return False
+
+
+def _probe(port):
+    # A query for a value absent from the corpus, which is answered fast
+    url = _query_url(f"http://localhost:{port}/query", '"__loadtest_probe__"', 0, 0, 'json')
+    try:
+        with urllib.request.urlopen(url, timeout=5) as resp:
+            json.loads(resp.read())
+            return resp.status == 200
+    except (OSError, ValueError):
+        return False
+
+
+def _sample_rss(pid, interval, samples, stop):
+    start = time.monotonic()
+    while True:
+        rss = _rss(pid)
+        if rss is not None:
+            samples.append((time.monotonic() - start, rss))
+        if stop.wait(interval):
+            return
+
+
+def _rss(pid):
+    try:
+        import psutil
+        return psutil.Process(pid).memory_info().rss
+    except ImportError:
+        pass
+    except Exception:
+        return None
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m concordancer.loadtest',
+                                     description="Load test the query server on a saved corpus")
+    parser.add_argument('index', help="directory of a saved corpus")
+    parser.add_argument('--queries', help="file of CQL queries, one per line (by default, a synthetic mix)")
+    parser.add_argument('--n-synthetic', type=int, default=100, help="number of synthetic queries")
+    parser.add_argument('--seed', type=int, default=None, help="seed of the synthetic queries")
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=None, help="requests per second")
+    parser.add_argument('--requests', type=int, default=None, help="number of requests")
+    parser.add_argument('--duration', type=float, default=None, help="seconds to send requests")
+    parser.add_argument('--left', type=int, default=5)
+    parser.add_argument('--right', type=int, default=5)
+    parser.add_argument('--format', default='compact', choices=['compact', 'json'])
+    parser.add_argument('--port', type=int, help="port of the server, by default a free port")
+    parser.add_argument('--interval', type=float, default=1.0, help="seconds between timeline points")
+    parser.add_argument('--timeout', type=float, default=60)
+    parser.add_argument('--output', help="path to save the report as JSON")
+    args = parser.parse_args(argv)
+
+    if args.queries is not None:
+        queries = read_query_log(args.queries)
+    else:
+        queries = synthetic_queries(args.index, n=args.n_synthetic, seed=args.seed)
+    report = load_test(args.index, queries, concurrency=args.concurrency, rate=args.rate,
+                       n_requests=args.requests, duration=args.duration, left=args.left,
+                       right=args.right, format=args.format, port=args.port,
+                       sample_interval=args.interval, timeout=args.timeout, output=args.output)
+
+    summary = report['summary']
+    latency = { k: (f"{v * 1000:.1f}ms" if v is not None else '-') for k, v in summary['latency'].items() }
+    print(f"requests: {summary['requests']}  errors: {summary['errors']}  "
+          f"throughput: {summary['throughput'] or 0:.1f}/s")
+    print('latency: ' + '  '.join( f"{k} {v}" for k, v in latency.items() ))
+    if summary['max_rss'] is not None:
+        print(f"max server RSS: {summary['max_rss'] / 2**20:.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
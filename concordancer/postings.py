@@ -0,0 +1,278 @@
+from array import array
+from itertools import chain
+from bisect import bisect_left, bisect_right
+from typing import Union, Sequence, Iterable
+from collections.abc import Mapping
+from .tokenStore import POSITION_TYPE
+
+BLOCK_SIZE = 128
+# Types of the offsets of positions in a block of CompressedPostings,
+# by number of bytes: 1, 2, 4, and 8
+OFFSET_TYPES = [ next( t for t in 'BHILQ' if array(t).itemsize == size ) for size in (1, 2, 4, 8) ]
+OFFSET_LIMITS = [ 1 << (8 * size) for size in (1, 2, 4, 8) ]
+
+
+class CompressedPostings:
+    """A posting list (sorted token positions) compressed in blocks
+
+    Positions are split into blocks of ``block_size`` positions. The
+    first position of every block is kept uncompressed in ``firsts``,
+    which serves as skip pointers: a position is looked up by finding
+    its block in ``firsts`` and reading that block only. The other
+    positions in a block are stored as offsets from the first one 
+    (frame of reference), all with the same number of bytes (1, 2, 4,
+    or 8, the fewest that fit the largest offset in the block). A block
+    is thus read as an :class:`array.array` of offsets, which is 
+    searched with :mod:`bisect` without decoding the block, and most
+    positions of frequent values take one or two bytes.
+
+    Positions can only be added in increasing order, by :meth:`append`
+    and :meth:`extend`, so that a posting list could be extended with
+    the positions of documents added to the corpus. The offsets in
+    the last block are encoded once the block is full.
+    """
+
+    __slots__ = ('block_size', 'firsts', 'offsets', 'widths', 'data', '_tail', '_n', '_last')
+
+    def __init__(self, positions: Iterable=(), block_size: int=BLOCK_SIZE):
+        self.block_size = block_size
+        self.firsts = array(POSITION_TYPE)
+        self.offsets = array(POSITION_TYPE)  # Start of each block in ``data``
+        self.widths = array('B')  # Index in OFFSET_TYPES of each encoded block
+        self.data = bytearray()
+        self._tail = []  # Offsets in the last block, until it is full
+        self._n = 0
+        self._last = -1
+        self.extend(positions)
+
+    def __len__(self):
+        return self._n
+
+    def __iter__(self):
+        return chain.from_iterable(map(self.block, range(len(self.firsts))))
+
+    def __repr__(self):
+        return f"<CompressedPostings: {self._n} positions in {self.nbytes} bytes>"
+
+    @property
+    def nbytes(self):
+        """Number of bytes taken by the compressed positions
+        """
+        return len(self.data) + len(self.widths) + self.firsts.itemsize * (len(self.firsts) + len(self.offsets) + len(self._tail))
+
+    def append(self, position: int):
+        """Add a position after the last position in the list
+        """
+        self.extend((position,))
+
+    def extend(self, positions: Iterable):
+        """Add positions, in increasing order, after the last position
+        in the list
+        """
+        tail, block_size = self._tail, self.block_size
+        n, last = self._n, self._last
+        first = self.firsts[-1] if self.firsts else 0
+        try:
+            for position in positions:
+                if position <= last:
+                    raise ValueError("Positions must be added in increasing order")
+                if n % block_size == 0:
+                    first = position
+                    self.firsts.append(position)
+                    self.offsets.append(len(self.data))
+                else:
+                    tail.append(position - first)
+                    if len(tail) == block_size - 1:
+                        self._encode_tail()
+                last = position
+                n += 1
+        finally:
+            self._n, self._last = n, last
+
+    def block(self, i: int):
+        """Decode the positions in the ``i``-th block
+
+        Returns
+        -------
+        list
+            The positions in the block
+        """
+        first = self.firsts[i]
+        return [first, *map(first.__add__, self._block_offsets(i))]
+
+    def select(self, positions: Iterable):
+        """Positions (sorted in increasing order) that are also in this list
+
+        The blocks that may contain one of ``positions`` are found by
+        bisecting ``firsts``, and the offsets of each of them are read
+        once for all the positions falling in it. A few positions are
+        looked up in the offsets with :mod:`bisect`, and many positions
+        in a set of the offsets.
+        """
+        if not hasattr(positions, '__getitem__'):
+            positions = list(positions)
+        firsts = self.firsts
+        n_blocks, n = len(firsts), len(positions)
+        found = []
+        if n_blocks == 0:
+            return found
+        b, i = 0, 0
+        while i < n:
+            b = bisect_right(firsts, positions[i], b) - 1
+            if b < 0:
+                # Skip the positions before the first block
+                b, i = 0, bisect_left(positions, firsts[0], i)
+                continue
+            # Positions in the range of the block
+            j = bisect_left(positions, firsts[b + 1], i) if b + 1 < n_blocks else n
+            first, offsets = firsts[b], self._block_offsets(b)
+            if j - i < 8:
+                for k in range(i, j):
+                    offset = positions[k] - first
+                    m = bisect_left(offsets, offset)
+                    if offset == 0 or (m < len(offsets) and offsets[m] == offset):
+                        found.append(positions[k])
+            else:
+                offsets = set(offsets)
+                offsets.add(0)
+                found.extend( p for p in positions[i:j] if p - first in offsets )
+            i = j
+        return found
+
+    def _block_offsets(self, i: int):
+        # Offsets from ``firsts[i]`` of the other positions in the
+        # ``i``-th block, in increasing order
+        if i < len(self.widths):
+            offsets = self.offsets
+            end = offsets[i + 1] if i + 1 < len(offsets) else len(self.data)
+            return array(OFFSET_TYPES[self.widths[i]], self.data[offsets[i]:end])
+        return self._tail
+
+    def _encode_tail(self):
+        largest = self._tail[-1]
+        width = next( w for w, limit in enumerate(OFFSET_LIMITS) if largest < limit )
+        self.widths.append(width)
+        self.data += array(OFFSET_TYPES[width], self._tail).tobytes()
+        self._tail.clear()
+
+
+class PostingsTable(Mapping):
+    """A read-only map from the values of an attribute to their posting
+    lists, which are stored back to back in a single sequence of 
+    positions, ordered by vocabulary id (the layout of the saved index)
+
+    Posting lists are slices of ``positions`` built on lookup, so if
+    ``positions`` is a :class:`memoryview` of a memory-mapped file, no
+    position is copied into the memory of the process.
+    """
+
+    def __init__(self, vocab: list, vocab_ids: dict, positions: Sequence, offsets: Sequence):
+        """
+        Parameters
+        ----------
+        vocab : list
+            Values of the attribute, indexed by vocabulary id
+        vocab_ids : dict
+            A map from values to their vocabulary ids
+        positions : Sequence
+            Posting lists of all values
+        offsets : Sequence
+            ``offsets[i - 1]`` and ``offsets[i]`` are the start and the
+            end of the posting list of the value with vocabulary id ``i``
+            in ``positions``
+        """
+        self.vocab = vocab
+        self.vocab_ids = vocab_ids
+        self.positions = positions
+        self.offsets = offsets
+        self._len = None
+
+    def __getitem__(self, value):
+        i = self.vocab_ids.get(value, 0)
+        if not (0 < i < len(self.offsets)) or self.offsets[i - 1] == self.offsets[i]:
+            raise KeyError(value)
+        return self.positions[self.offsets[i - 1]:self.offsets[i]]
+
+    def __iter__(self):
+        offsets = self.offsets
+        for i in range(1, len(offsets)):
+            if offsets[i] > offsets[i - 1]:
+                yield self.vocab[i]
+
+    def __len__(self):
+        if self._len is None:
+            self._len = sum( 1 for _ in self )
+        return self._len
+
+    @property
+    def nbytes(self):
+        """Number of bytes taken by the positions and offsets
+        """
+        return sum( a.nbytes if hasattr(a, 'nbytes') else a.itemsize * len(a) for a in (self.positions, self.offsets) )
+
+
+def compress(positions: Sequence, min_size: int=BLOCK_SIZE, block_size: int=BLOCK_SIZE):
+    """Compress a posting list if it has at least ``min_size`` positions.
+    Shorter lists are returned unchanged, since they are too small for
+    compression to pay off.
+    """
+    if isinstance(positions, CompressedPostings) or len(positions) < min_size:
+        return positions
+    return CompressedPostings(positions, block_size=block_size)
+
+
+def decompress(positions: Union[Sequence, CompressedPostings]):
+    """A posting list as an array of positions
+    """
+    if isinstance(positions, array):
+        return positions
+    a = array(POSITION_TYPE)
+    if isinstance(positions, memoryview):
+        a.frombytes(positions.cast('B'))
+    else:
+        a.extend(positions)
+    return a
+
+
+def intersect(a: Union[Sequence, CompressedPostings], b: Union[Sequence, CompressedPostings]):
+    """Positions in both of two posting lists
+
+    The shorter list is walked through, and its positions are looked
+    up in the longer list by galloping, so the cost depends mostly on
+    the length of the shorter list. Posting lists can be sorted
+    sequences (e.g., arrays or lists) or
+    :class:`CompressedPostings`.
+
+    Returns
+    -------
+    list
+        The common positions, in increasing order
+    """
+    if len(a) > len(b):
+        a, b = b, a
+    if isinstance(b, CompressedPostings):
+        return b.select(a)
+
+    found = []
+    lo, hi = 0, len(b)
+    for position in a:
+        lo = _gallop(b, position, lo, hi)
+        if lo == hi:
+            break
+        if b[lo] == position:
+            found.append(position)
+    return found
+
+
+def _gallop(seq, target, lo: int, hi: int, right=False):
+    """Like ``bisect_left`` (or ``bisect_right``) on ``seq[lo:hi]``,
+    but probes exponentially growing steps from ``lo`` first, which
+    is faster when the target is close to ``lo``
+    """
+    probe, step = lo, 1
+    while probe < hi and (seq[probe] <= target if right else seq[probe] < target):
+        lo = probe + 1
+        probe += step
+        step <<= 1
+    bisect = bisect_right if right else bisect_left
+    return bisect(seq, target, lo, min(probe, hi))
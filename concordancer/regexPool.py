@@ -0,0 +1,102 @@
+import os
+import re
+import math
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+# Vocabularies of the corpus in a worker process
+_worker_vocab = None
+
+
+class RegexPool:
+    """A pool of processes matching regular expressions against the
+    vocabularies of a corpus
+
+    The vocabularies are handed to the workers once, when the pool
+    starts, so a search only sends the pattern and the range of
+    vocabulary ids to each worker, and receives the ids of the matching
+    values. Vocabularies only grow, so a pool is up to date as long as
+    the sizes of the vocabularies are unchanged (see :meth:`is_current`).
+
+    Searches hold the pool between :meth:`acquire` and :meth:`release`,
+    and :meth:`shutdown` waits for them to release the pool before
+    stopping the workers, so that a pool could be replaced while it is
+    in use.
+    """
+
+    def __init__(self, vocab: dict, workers: int=None):
+        """Start a pool of workers
+
+        Parameters
+        ----------
+        vocab : dict
+            Vocabularies of the attributes of the corpus, as in
+            :attr:`~concordancer.tokenStore.TokenStore.vocab`
+        workers : int, optional
+            Number of worker processes, by default None, which uses
+            the number of CPUs
+        """
+        self.workers = workers or os.cpu_count() or 1
+        self.sizes = { attr: len(values) for attr, values in vocab.items() }
+        self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(vocab,))
+        self._lock = threading.Lock()
+        self._users = 0
+        self._closed = False
+
+    def is_current(self, vocab: dict):
+        """Whether the workers hold the current state of ``vocab``
+        """
+        return all( self.sizes.get(attr) == len(values) for attr, values in vocab.items() )
+
+    def match(self, attr, pattern: re.Pattern):
+        """Vocabulary ids of the values of ``attr`` matching ``pattern``
+
+        The vocabulary is split into a few chunks per worker, which
+        are searched in parallel.
+
+        Returns
+        -------
+        list
+            Vocabulary ids in increasing order
+        """
+        n = self.sizes.get(attr, 0)
+        if n <= 1:
+            return []
+        chunk_size = math.ceil((n - 1) / (4 * self.workers))
+        futures = [ self.executor.submit(_match_chunk, attr, pattern, start, min(start + chunk_size, n))
+                    for start in range(1, n, chunk_size) ]
+        return [ i for future in futures for i in future.result() ]
+
+    def acquire(self):
+        """Hold the pool for a search, until :meth:`release`
+        """
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The pool is shut down")
+            self._users += 1
+
+    def release(self):
+        with self._lock:
+            self._users -= 1
+            stop = self._closed and self._users == 0
+        if stop:
+            self.executor.shutdown(wait=False)
+
+    def shutdown(self):
+        """Stop the workers once no search holds the pool
+        """
+        with self._lock:
+            self._closed = True
+            stop = self._users == 0
+        if stop:
+            self.executor.shutdown(wait=False)
+
+
+def _init_worker(vocab):
+    global _worker_vocab
+    _worker_vocab = vocab
+
+
+def _match_chunk(attr, pattern, start, end):
+    vocab = _worker_vocab[attr]
+    return [ i for i in range(start, end) if pattern.search(vocab[i]) ]
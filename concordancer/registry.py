@@ -0,0 +1,190 @@
+import time
+import threading
+from collections import OrderedDict
+from .concordancer import Concordancer
+
+
+class CorpusRegistry:
+    """A collection of named corpora saved by
+    :meth:`~concordancer.indexedCorpus.IndexedCorpus.save`
+
+    Corpora are loaded the first time they are requested, and loaded
+    corpora are shared by all threads using the registry. When the
+    memory taken by the loaded corpora exceeds ``memory_limit``,
+    the least recently used corpora are unloaded until the total
+    fits in the limit again (the corpus just requested is always
+    kept). An unloaded corpus is loaded again when requested.
+    """
+
+    def __init__(self, corpora: dict=None, memory_limit: int=None, normalizers: dict=None, mmap=False):
+        """Initialize a registry of corpora
+
+        Parameters
+        ----------
+        corpora : dict, optional
+            A dictionary mapping names of corpora to the directories
+            they are saved in, by default None
+        memory_limit : int, optional
+            Maximum memory (in bytes) of the loaded corpora, by default
+            None, which never unloads corpora. The memory of a corpus is
+            estimated by
+            :meth:`~concordancer.indexedCorpus.IndexedCorpus.memory_usage`.
+        normalizers : dict, optional
+            Normalizers of custom CQL flags, passed to
+            :meth:`~concordancer.indexedCorpus.IndexedCorpus.load`
+        mmap : bool, optional
+            Map the corpora from their files instead of reading them, 
+            by default False. See
+            :meth:`~concordancer.indexedCorpus.IndexedCorpus.load`.
+        """
+        self.memory_limit = memory_limit
+        self.normalizers = normalizers
+        self.mmap = mmap
+        self._paths = {}
+        self._loaded = OrderedDict()
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._unload_callbacks = []
+        for name, path in (corpora or {}).items():
+            self.register(name, path)
+
+    def __contains__(self, name):
+        return name in self._paths
+
+    def register(self, name: str, path: str):
+        """Add a corpus to the registry without loading it
+
+        Parameters
+        ----------
+        name : str
+            Name of the corpus
+        path : str
+            Directory the corpus is saved in
+        """
+        with self._lock:
+            self._paths[name] = str(path)
+            self._load_locks[name] = threading.Lock()
+            self._stats[name] = {
+                'name': name,
+                'path': str(path),
+                'loaded': False,
+                'load_time': None,
+                'memory': None,
+                'n_loads': 0,
+                'last_used': None,
+            }
+
+    def add_unload_callback(self, callback):
+        """Call ``callback(name)`` whenever a corpus is unloaded (either
+        by :meth:`unload`, or when the memory limit is exceeded), e.g.,
+        to drop other references to the corpus, so that its memory is
+        freed
+
+        Parameters
+        ----------
+        callback : Callable
+            A function taking the name of the unloaded corpus
+        """
+        self._unload_callbacks.append(callback)
+
+    def get(self, name: str):
+        """Get a corpus, loading it if it is not loaded yet
+
+        Parameters
+        ----------
+        name : str
+            Name of the corpus
+
+        Returns
+        -------
+        Concordancer
+            The corpus
+
+        Raises
+        ------
+        KeyError
+            If no corpus is registered with ``name``
+        """
+        if name not in self._paths:
+            raise KeyError(f"Corpus {name} not in registry")
+
+        # Avoid loading the same corpus twice in parallel
+        with self._load_locks[name]:
+            with self._lock:
+                C = self._loaded.get(name)
+                if C is not None:
+                    self._loaded.move_to_end(name)
+                    self._stats[name]['last_used'] = time.time()
+                    return C
+
+            start = time.perf_counter()
+            C = Concordancer.load(self._paths[name], normalizers=self.normalizers, mmap=self.mmap)
+            load_time = time.perf_counter() - start
+
+            with self._lock:
+                self._loaded[name] = C
+                stats = self._stats[name]
+                stats['loaded'] = True
+                stats['load_time'] = load_time
+                stats['memory'] = C.memory_usage()
+                stats['n_loads'] += 1
+                stats['last_used'] = time.time()
+                evicted = self._evict(keep=name)
+
+        for name in evicted:
+            self._unloaded(name)
+        return C
+
+    def unload(self, name: str):
+        """Unload a corpus from memory
+
+        Parameters
+        ----------
+        name : str
+            Name of the corpus
+        """
+        with self._lock:
+            if self._loaded.pop(name, None) is None:
+                return
+            self._stats[name]['loaded'] = False
+        self._unloaded(name)
+
+    def memory_usage(self):
+        """Estimated memory taken by the loaded corpora, in bytes
+        """
+        return sum( self._stats[name]['memory'] for name in self._loaded )
+
+    def stats(self):
+        """Status of the corpora in the registry
+
+        Returns
+        -------
+        list
+            A list of dictionaries, one for each corpus, with the keys
+            ``name``, ``path``, ``loaded``, ``load_time`` (seconds taken
+            by the last load), ``memory`` (estimated bytes taken when
+            last loaded), ``n_loads``, and ``last_used`` (UNIX time)
+        """
+        with self._lock:
+            return [ dict(stats) for stats in self._stats.values() ]
+
+    def _evict(self, keep: str):
+        # Called with self._lock held. Returns the names of the unloaded
+        # corpora, whose callbacks are called once the lock is released
+        evicted = []
+        if self.memory_limit is None:
+            return evicted
+        for name in list(self._loaded):
+            if self.memory_usage() <= self.memory_limit:
+                break
+            if name == keep:
+                continue
+            del self._loaded[name]
+            self._stats[name]['loaded'] = False
+            evicted.append(name)
+        return evicted
+
+    def _unloaded(self, name: str):
+        for callback in self._unload_callbacks:
+            callback(name)
@@ -1,14 +1,21 @@
 import os
+import gzip
 import json
-import cqls
+import zlib
 import falcon
+import hashlib
 import pathlib
 import logging
-import webbrowser
+import threading
+from collections import OrderedDict
+from socketserver import ThreadingMixIn
 from urllib.parse import unquote
 from falcon_cors import CORS
 from wsgiref import simple_server
 from .concordancer import Concordancer
+from .registry import CorpusRegistry
+from .export import ConcordanceWriter, query_labels
+from .utils import parse_cql
 
 FRONTEND_ZIP = 'https://github.com/liao961120/concordancer/raw/query-interface/dist.zip'
 URL_ESCAPES = [
@@ -28,7 +35,10 @@ URL_ESCAPES = [
     ["+", "___PLUS___"],
     ["$", "___END_ANCHOR___"],
     [",", "___COMMA___"],
+    ["%", "___PERCENT___"],
 ]
+# Appended to the ETag of a gzip-encoded response
+GZIP_ETAG_SUFFIX = '-gz'
 
 
 def run(Concordancer, port=1420, url=None, open_browser=True):
@@ -45,7 +55,53 @@ def run(Concordancer, port=1420, url=None, open_browser=True):
         which uses the path to local query interface bundled
         with the library
     open_browser : bool, optional
-        Automatically visit the url with the browser, by default True
+        Automatically visit the url with the browser, by default True.
+        The query interface is downloaded first if it is not found
+        locally.
+    """
+    app = create_app(Concordancer)
+
+    print(f"Initializing server...")
+    httpd = simple_server.make_server('localhost', port, app)
+    print(f"Start serving at http://localhost:{port}")
+    if open_browser:
+        import webbrowser
+        if url is None:
+            url = query_interface_path()
+            if not os.path.exists(url):
+                try:
+                    download_query_interface(force=False)
+                except Exception:
+                    logging.warning("Skip download query interface")
+        webbrowser.open(url)
+    httpd.serve_forever()
+
+
+def create_app(Concordancer):
+    """Create the WSGI application served by :func:`run`
+
+    The application could also be served by other WSGI servers. With a
+    pre-fork server (e.g., gunicorn), load the corpus with 
+    ``Concordancer.load(path, mmap=True)``, so that the workers share 
+    a single copy of the corpus in memory:
+
+    .. code-block:: python
+
+        # app.py, served with `gunicorn --workers 4 app:app`
+        from concordancer.concordancer import Concordancer
+        from concordancer.server import create_app
+
+        app = create_app(Concordancer.load("corpus_index/", mmap=True))
+
+    Parameters
+    ----------
+    Concordancer : Concordancer
+        A concordancer object
+
+    Returns
+    -------
+    falcon.App
+        The WSGI application
     """
     # Allow access from frontend
     cors = CORS(allow_all_origins=True)
@@ -55,34 +111,123 @@ def run(Concordancer, port=1420, url=None, open_browser=True):
     serv = ConcordancerBackend(Concordancer)
     app.add_route('/query', serv)
     app.add_route('/export', serv, suffix='export')
+    return app
+
+
+def run_registry(corpora, port=1420, memory_limit: int=None):
+    """Serve multiple corpora saved on disk
+
+    Corpora are loaded when they are first queried and are unloaded,
+    least recently used first, when their memory exceeds 
+    ``memory_limit`` (see :class:`~concordancer.registry.CorpusRegistry`).
+    Requests are handled in parallel threads sharing the loaded corpora.
+
+    Parameters
+    ----------
+    corpora : Union[dict, CorpusRegistry]
+        A dictionary mapping names of corpora to the directories they 
+        are saved in (by :meth:`~concordancer.Concordancer.save`), or 
+        a :class:`~concordancer.registry.CorpusRegistry`
+    port : int, optional
+        The port the server listens on, by default 1420
+    memory_limit : int, optional
+        Maximum memory (in bytes) of the loaded corpora, by default None,
+        which never unloads corpora. Ignored if ``corpora`` is a
+        :class:`~concordancer.registry.CorpusRegistry`.
+    
+    Notes
+    -----
+    The endpoint ``/corpora`` lists the corpora with their load time 
+    and memory, and the endpoints ``/corpora/<name>/query`` and 
+    ``/corpora/<name>/export`` work as ``/query`` and ``/export`` of
+    :class:`ConcordancerBackend` for the corpus ``<name>``.
+    """
+    if not isinstance(corpora, CorpusRegistry):
+        corpora = CorpusRegistry(corpora, memory_limit=memory_limit)
+
+    cors = CORS(allow_all_origins=True)
+    app = falcon.API(middleware=[cors.middleware])
+    serv = RegistryBackend(corpora)
+    app.add_route('/corpora', serv)
+    app.add_route('/corpora/{name}/query', serv, suffix='query')
+    app.add_route('/corpora/{name}/export', serv, suffix='export')
 
     print(f"Initializing server...")
-    httpd = simple_server.make_server('localhost', port, app)
-    print(f"Start serving at http://localhost:{port}")
-    if url is None:
-        url = query_interface_path()
-    if open_browser:
-        webbrowser.open(url)
+    httpd = simple_server.make_server('localhost', port, app, server_class=ThreadingWSGIServer)
+    print(f"Start serving at http://localhost:{port}/corpora")
     httpd.serve_forever()
 
 
+class ThreadingWSGIServer(ThreadingMixIn, simple_server.WSGIServer):
+    daemon_threads = True
+
+
+class RegistryBackend(object):
+    """Falcon API to serve the corpora in a 
+    :class:`~concordancer.registry.CorpusRegistry`
+    """
+    def __init__(self, registry: CorpusRegistry):
+        self.registry = registry
+        self._backends = {}
+        self._lock = threading.Lock()
+        # Drop the backend (and its cache) of an unloaded corpus, which
+        # would otherwise keep the corpus in memory
+        registry.add_unload_callback(self._drop_backend)
+
+    def on_get(self, req, resp):
+        """Handling GET requests sent to ``/corpora``, which responds 
+        with :meth:`~concordancer.registry.CorpusRegistry.stats`
+        """
+        resp.text = json.dumps(self.registry.stats(), ensure_ascii=False)
+
+    def on_get_query(self, req, resp, name):
+        """Handling GET requests sent to ``/corpora/<name>/query``
+        """
+        self._backend(name).on_get(req, resp)
+
+    def on_get_export(self, req, resp, name):
+        """Handling GET requests sent to ``/corpora/<name>/export``
+        """
+        self._backend(name).on_get_export(req, resp)
+
+    def _backend(self, name):
+        if name not in self.registry:
+            raise falcon.HTTPNotFound(description=f"Corpus {name} not found")
+        C = self.registry.get(name)
+        with self._lock:
+            backend = self._backends.get(name)
+            # A new backend (with its own cache) for a reloaded corpus
+            if backend is None or backend.C is not C:
+                backend = self._backends[name] = ConcordancerBackend(C)
+        return backend
+
+    def _drop_backend(self, name):
+        with self._lock:
+            self._backends.pop(name, None)
+
+
 class ConcordancerBackend(object):
     """Falcon API to serve the concordancer object for the query interface
 
     Notes
     -----
-    Two API endpoints, ``/query`` and ``/export``, are exposed. The endpoint 
-    ``/export`` accepts a GET request and responds by sending the most recent
-    queried results back to the front-end in JSON format. The data sent back 
-    are identical to the data returned by 
-    :func:`~concordancer.Concordancer.cql_search` (converted to JSON).
-    For the endpoint ``/query``, see the doc in 
-    :func:`~server.ConcordancerBackend.on_get`
+    Two API endpoints, ``/query`` and ``/export``, are exposed. For the 
+    endpoint ``/query``, see the doc in 
+    :func:`~server.ConcordancerBackend.on_get`, and for ``/export``, see 
+    :func:`~server.ConcordancerBackend.on_get_export`.
+
+    Responses are gzip-compressed for clients that accept it. Responses 
+    of the most recent queries are cached, and ``/query`` responses carry 
+    an ETag so that clients can revalidate them with ``If-None-Match``.
     """
+    _cache_size = 32
+
     def __init__(self, Concordancer):
         # Initialize corpus
         self.C = Concordancer
-        self.concord_list = []
+        self._last_query = None
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
 
     def on_get(self, req, resp):
         """Handling GET requests sent to ``/query``
@@ -100,6 +245,10 @@ class ConcordancerBackend(object):
         in the query string of the URL sent to this endpoint. ``query``
         holds the CQL query entered by the user. ``left`` and ``right`` set
         the left and right context sizes of the returned concordance lines.
+        An optional parameter ``format`` may be set to ``compact`` to 
+        receive the results in the format described in 
+        :func:`~server.compact_results`, instead of the full token 
+        dictionaries returned by default.
 
         Due to the conflicts between CQL metacharacters and URL specification,
         some characters are replaced with safe ones in the front-end and
@@ -112,15 +261,13 @@ class ConcordancerBackend(object):
             'query': '',
             'left': '10',
             'right': '10',
+            'format': 'json',
         }
         # Parse query string
         for k, v in req.params.items():
             params[k] = v
         params['left'] = int(params['left'])
         params['right'] = int(params['right'])
-        ############ DEBUGGING ##############
-        print("Searching corpus...")
-        ############ _DEBUGGING ##############
 
         # Restore escaped characters in URL back to original forms
         cql = params['query']
@@ -128,29 +275,58 @@ class ConcordancerBackend(object):
             cql = cql.replace(escape, char)
         # Test CQL syntax
         try:
-            cqls.parse(cql)
+            parse_cql(cql)
         except:
             resp.status = falcon.HTTP_400
             resp.text = 'CQL Syntax error'
+            return
 
-        # Query Database
-        self.concord_list = list(
-            self.C.cql_search(
-                cql,
-                left=params['left'],
-                right=params['right']
+        key = (cql, params['left'], params['right'], params['format'], 
+               self.C._cql_default_attr, self.C._cql_max_quantity, self.C._cql_default_within, self.C._version)
+        self._last_query = key
+        with self._lock:
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+        if cached is None:
+            ############ DEBUGGING ##############
+            print("Searching corpus...")
+            ############ _DEBUGGING ##############
+            # Query Database
+            concord_list = list(
+                self.C.cql_search(
+                    cql,
+                    left=params['left'],
+                    right=params['right']
+                )
             )
-        )
 
-        # Response to frontend
-        ############ DEBUGGING ##############
-        print(f"Found {len(self.concord_list)} results...\n")
-        ############ _DEBUGGING ##############
+            # Response to frontend
+            ############ DEBUGGING ##############
+            print(f"Found {len(concord_list)} results...\n")
+            ############ _DEBUGGING ##############
+            if params['format'] == 'compact':
+                results = compact_results(concord_list, self.C.tokens.attrs)
+            else:
+                results = {'results': concord_list}
+            results['default_attr'] = self.C._cql_default_attr
+            body = json.dumps(results, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            cached = { 'etag': hashlib.sha1(body).hexdigest(), 'body': body }
+            with self._lock:
+                self._cache[key] = cached
+                if len(self._cache) > self._cache_size:
+                    self._cache.popitem(last=False)
+
+        # The gzip-encoded body has its own ETag, as it is a different
+        # representation of the results
+        etag = cached['etag'] + (GZIP_ETAG_SUFFIX if accepts_gzip(req) else '')
+        resp.set_header('ETag', f'"{etag}"')
+        if etag_matches(req.get_header('If-None-Match'), cached['etag']):
+            resp.append_header('Vary', 'Accept-Encoding')
+            resp.status = falcon.HTTP_304
+            return
         resp.status = falcon.HTTP_200  # This is the default status
-        resp.text = json.dumps({
-            'results': self.concord_list,
-            'default_attr': self.C._cql_default_attr
-        }, ensure_ascii=False)
+        send_body(req, resp, cached)
 
     def on_get_export(self, req, resp):
         """Handling GET requests sent to ``/export``
@@ -164,9 +340,201 @@ class ConcordancerBackend(object):
         
         Notes
         -----
-        Sends the most recent queried results back to the front-end in JSON
+        Sends the results of a query back to the front-end as a file. 
+        The results are streamed as they are found, instead of being 
+        collected in memory first. The query string may contain the 
+        parameters ``query``, ``left``, and ``right`` (as in 
+        :func:`~server.ConcordancerBackend.on_get`), ``format`` 
+        (``json``, ``jsonl``, ``tsv``, or ``csv``, by default ``json``), 
+        and ``attrs`` (comma-separated attributes of tokens to export). 
+        If ``query`` is not given, the most recent query sent to 
+        ``/query`` is exported.
         """
-        resp.text = json.dumps(self.concord_list, ensure_ascii=False, indent="\t")
+        params = {
+            'left': '10',
+            'right': '10',
+            'format': 'json',
+        }
+        for k, v in req.params.items():
+            params[k] = v
+        if 'query' in params:
+            cql = params['query']
+            for char, escape in URL_ESCAPES:
+                cql = cql.replace(escape, char)
+            left, right = int(params['left']), int(params['right'])
+        elif self._last_query is not None:
+            cql, left, right = self._last_query[:3]
+        else:
+            cql = None
+        attrs = params['attrs'].split(',') if 'attrs' in params else None
+
+        try:
+            queries = [] if cql is None else parse_cql(cql, 
+                default_attr=self.C._cql_default_attr, max_quant=self.C._cql_max_quantity)
+            writer = ConcordanceWriter(params['format'], attrs=attrs, labels=query_labels(queries))
+        except ValueError as e:
+            resp.status = falcon.HTTP_400
+            resp.text = str(e)
+            return
+        except:
+            resp.status = falcon.HTTP_400
+            resp.text = 'CQL Syntax error'
+            return
+
+        def lines():
+            yield writer.header()
+            if cql is not None:
+                for result in self.C.cql_search(cql, left=left, right=right):
+                    yield writer.line(result)
+            yield writer.footer()
+
+        resp.content_type = {
+            'json': falcon.MEDIA_JSON,
+            'jsonl': 'application/jsonl; charset=utf-8',
+            'tsv': 'text/tab-separated-values; charset=utf-8',
+            'csv': 'text/csv; charset=utf-8',
+        }[params['format']]
+        resp.set_header('Content-Disposition', f'attachment; filename="concordance_list.{params["format"]}"')
+        resp.append_header('Vary', 'Accept-Encoding')
+        compress = accepts_gzip(req)
+        if compress:
+            resp.set_header('Content-Encoding', 'gzip')
+        resp.stream = stream_chunks(lines(), compress=compress)
+
+
+def compact_results(results: list, attrs: list):
+    """Encode concordance lines in a compact format for sending over network
+
+    Parameters
+    ----------
+    results : list
+        Concordance lines returned by 
+        :func:`~concordancer.Concordancer.cql_search`
+    attrs : list
+        Attributes of the tokens in the corpus
+
+    Returns
+    -------
+    dict
+        The encoded concordance lines, structured as:
+
+        .. code-block:: python
+
+            {
+                'format': 'compact',
+                'attrs': ['word', 'pos'],
+                'vocab': [
+                    ['覺得', '材質', ...],   # values of 'word'
+                    ['VK', 'Na', ...]       # values of 'pos'
+                ],
+                'results': [
+                    [<left>, <keyword>, <right>, [<doc_idx>, <sent_idx>, <tk_idx>], <captureGroups>],
+                    ...
+                ]
+            }
+
+        where ``<left>``, ``<keyword>``, ``<right>``, and the values of 
+        ``<captureGroups>`` (a dictionary keyed by labels) are lists of 
+        tokens. A token is a list of indices into ``vocab``, one for 
+        each attribute in ``attrs``, with ``None`` for attributes 
+        the token lacks.
+    """
+    vocab = [ [] for _ in attrs ]
+    vocab_ids = [ {} for _ in attrs ]
+
+    def encode(tokens):
+        rows = []
+        for token in tokens:
+            row = []
+            for i, attr in enumerate(attrs):
+                value = token.get(attr, None)
+                if value is None:
+                    row.append(None)
+                    continue
+                ids = vocab_ids[i]
+                if value not in ids:
+                    ids[value] = len(vocab[i])
+                    vocab[i].append(value)
+                row.append(ids[value])
+            rows.append(row)
+        return rows
+
+    encoded = []
+    for cc in results:
+        position = cc['position']
+        encoded.append([
+            encode(cc['left']),
+            encode(cc['keyword']),
+            encode(cc['right']),
+            [position['doc_idx'], position['sent_idx'], position['tk_idx']],
+            { label: encode(tokens) for label, tokens in cc['captureGroups'].items() }
+        ])
+
+    return {
+        'format': 'compact',
+        'attrs': list(attrs),
+        'vocab': vocab,
+        'results': encoded
+    }
+
+
+def accepts_gzip(req):
+    return 'gzip' in (req.get_header('Accept-Encoding') or '')
+
+
+def send_body(req, resp, content: dict):
+    """Set the body of a JSON response, gzip-compressing it if the
+    client accepts it. A compressed body is stored back in ``content``
+    under the key ``gzip`` for reuse.
+    """
+    resp.content_type = falcon.MEDIA_JSON
+    resp.append_header('Vary', 'Accept-Encoding')
+    if accepts_gzip(req):
+        if 'gzip' not in content:
+            content['gzip'] = gzip.compress(content['body'], compresslevel=6)
+        resp.set_header('Content-Encoding', 'gzip')
+        resp.data = content['gzip']
+    else:
+        resp.data = content['body']
+
+
+def stream_chunks(lines, chunk_size=65536, compress=False):
+    """Encode lines of text into chunks of bytes for streaming responses, 
+    optionally gzip-compressing them
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+    buffer, size = [], 0
+    for line in lines:
+        buffer.append(line)
+        size += len(line)
+        if size >= chunk_size:
+            chunk = ''.join(buffer).encode('utf-8')
+            buffer, size = [], 0
+            if compressor is not None:
+                chunk = compressor.compress(chunk)
+            if chunk:
+                yield chunk
+    chunk = ''.join(buffer).encode('utf-8')
+    if compressor is not None:
+        chunk = compressor.compress(chunk) + compressor.flush()
+    if chunk:
+        yield chunk
+
+
+def etag_matches(if_none_match: str, etag: str):
+    """Whether ``If-None-Match`` holds the ETag of either the identity
+    or the gzip-encoded body (see :data:`GZIP_ETAG_SUFFIX`) of a response
+    whose identity body has the ETag ``etag``
+    """
+    if if_none_match is None:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip().replace('W/', '', 1).strip('"')
+        if tag.endswith(GZIP_ETAG_SUFFIX):
+            tag = tag[:-len(GZIP_ETAG_SUFFIX)]
+        if tag == '*' or tag == etag:
+            return True
+    return False
 
 
 ########################################
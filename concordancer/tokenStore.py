@@ -0,0 +1,186 @@
+from array import array
+from bisect import bisect_right
+from typing import Union, Iterable
+
+VOCAB_ID_TYPE = 'I'
+POSITION_TYPE = 'L'
+
+
+class TokenStore:
+    """Columnar storage of the tokens in a corpus
+
+    Tokens are not kept as dictionaries. Instead, every attribute
+    of the tokens (e.g., ``word`` or ``pos``) is stored as an array
+    of vocabulary ids, one id per token. The tokens of the corpus are
+    laid out in a single sequence, so that a token is identified by its
+    (global) position in the corpus. Sentence and document boundaries
+    are kept in two offset arrays:
+
+    - ``sent_offsets[i]`` is the position of the first token of
+      the i-th sentence in the corpus
+    - ``doc_offsets[d]`` is the index (in ``sent_offsets``) of the
+      first sentence of the d-th document
+
+    Both offset arrays end with an extra element marking the end
+    of the corpus. Dictionaries representing tokens are only built
+    on demand by :meth:`token` and :meth:`tokens`.
+    """
+
+    def __init__(self):
+        self.attrs = []
+        self.vocab = {}
+        self.vocab_ids = {}
+        self.columns = {}
+        self.sent_offsets = array(POSITION_TYPE, [0])
+        self.doc_offsets = array(POSITION_TYPE, [0])
+        self._ranks = {}
+
+    def __len__(self):
+        return self.sent_offsets[-1]
+
+    @property
+    def n_docs(self):
+        return len(self.doc_offsets) - 1
+
+    def append_document(self, sentences: Iterable):
+        """Append a document to the end of the store
+
+        Parameters
+        ----------
+        sentences : Iterable
+            Sentences of the document, each being a list of tokens
+            represented as dictionaries
+
+        Returns
+        -------
+        range
+            The positions of the tokens in the document
+        """
+        start = n = len(self)
+        for sent in sentences:
+            for token in sent:
+                for attr, value in token.items():
+                    if attr not in self.columns:
+                        self._add_attr(attr, n)
+                    ids = self.vocab_ids[attr]
+                    if value not in ids:
+                        ids[value] = len(self.vocab[attr])
+                        self.vocab[attr].append(value)
+                for attr in self.attrs:
+                    value = token.get(attr, None)
+                    self.columns[attr].append(0 if value is None else self.vocab_ids[attr][value])
+                n += 1
+            self.sent_offsets.append(n)
+        self.doc_offsets.append(len(self.sent_offsets) - 1)
+
+        return range(start, len(self))
+
+    def append_empty_document(self):
+        """Append a document without any token, e.g., as a
+        placeholder of a deleted document
+        """
+        self.doc_offsets.append(self.doc_offsets[-1])
+
+    def drop_documents(self, doc_ids: Iterable):
+        """Remove the tokens of documents from the store
+
+        The documents are kept as empty documents, so the indices of
+        the other documents are unchanged. Token positions after the
+        removed documents do shift.
+        """
+        doc_ids = set(doc_ids)
+        columns = { attr: array(VOCAB_ID_TYPE) for attr in self.attrs }
+        sent_offsets = array(POSITION_TYPE, [0])
+        doc_offsets = array(POSITION_TYPE, [0])
+        for doc_idx in range(self.n_docs):
+            if doc_idx not in doc_ids:
+                first_sent, last_sent = self.doc_offsets[doc_idx], self.doc_offsets[doc_idx + 1]
+                start, end = self.sent_offsets[first_sent], self.sent_offsets[last_sent]
+                for attr in self.attrs:
+                    columns[attr].extend(self.columns[attr][start:end])
+                shift = sent_offsets[-1] - start
+                sent_offsets.extend( offset + shift for offset in self.sent_offsets[first_sent + 1:last_sent + 1] )
+            doc_offsets.append(len(sent_offsets) - 1)
+
+        self.columns = columns
+        self.sent_offsets = sent_offsets
+        self.doc_offsets = doc_offsets
+
+    def token(self, position: int):
+        """Build the dictionary of the token at a position
+        """
+        token = {}
+        for attr in self.attrs:
+            vocab_id = self.columns[attr][position]
+            if vocab_id != 0:
+                token[attr] = self.vocab[attr][vocab_id]
+        return token
+
+    def tokens(self, start: int, end: int):
+        """Build the dictionaries of the tokens in a range of positions
+        """
+        return [ self.token(i) for i in range(start, end) ]
+
+    def value(self, attr: Union[str, int], position: int):
+        """Value of a token's attribute, or None if the token lacks it
+        """
+        return self.vocab[attr][self.columns[attr][position]]
+
+    def vocab_ranks(self, attr: Union[str, int]):
+        """Ranks of the values of an attribute in sorted order, indexed
+        by vocabulary id, so that tokens can be sorted by comparing the 
+        ranks of their vocabulary ids. Values are compared as strings,
+        and the missing value (id 0) has rank 0.
+        """
+        vocab = self.vocab[attr]
+        ranks = self._ranks.get(attr)
+        if ranks is None or len(ranks) != len(vocab):
+            ranks = array(VOCAB_ID_TYPE, bytes(len(vocab) * array(VOCAB_ID_TYPE).itemsize))
+            for rank, vocab_id in enumerate(sorted(range(1, len(vocab)), key=lambda i: str(vocab[i])), 1):
+                ranks[vocab_id] = rank
+            self._ranks[attr] = ranks
+        return ranks
+
+    def locate(self, position: int):
+        """Convert a position in the corpus to ``(doc_idx, sent_idx, tk_idx)``
+        """
+        sent = bisect_right(self.sent_offsets, position) - 1
+        doc = bisect_right(self.doc_offsets, sent) - 1
+        return doc, sent - self.doc_offsets[doc], position - self.sent_offsets[sent]
+
+    def position(self, doc_idx: int, sent_idx: int=0, tk_idx: int=0):
+        """Convert ``(doc_idx, sent_idx, tk_idx)`` to a position in the corpus
+        """
+        return self.sent_offsets[self.doc_offsets[doc_idx] + sent_idx] + tk_idx
+
+    def doc_bounds(self, doc_idx: int):
+        """Positions of the first token and the end of a document
+        """
+        doc_offsets = self.doc_offsets
+        return self.sent_offsets[doc_offsets[doc_idx]], self.sent_offsets[doc_offsets[doc_idx + 1]]
+
+    def sent_bounds(self, position: int):
+        """Positions of the first token and the end of the sentence
+        containing the token at ``position``
+        """
+        sent = bisect_right(self.sent_offsets, position) - 1
+        return self.sent_offsets[sent], self.sent_offsets[sent + 1]
+
+    def doc_bounds_at(self, position: int):
+        """Positions of the first token and the end of the document
+        containing the token at ``position``
+        """
+        sent = bisect_right(self.sent_offsets, position) - 1
+        return self.doc_bounds(bisect_right(self.doc_offsets, sent) - 1)
+
+    def doc_sentences(self, doc_idx: int):
+        """Number of sentences in a document
+        """
+        return self.doc_offsets[doc_idx + 1] - self.doc_offsets[doc_idx]
+
+    def _add_attr(self, attr, n_tokens):
+        self.attrs.append(attr)
+        self.vocab[attr] = [None]
+        self.vocab_ids[attr] = {}
+        # Tokens stored before the attribute appears lack it
+        self.columns[attr] = array(VOCAB_ID_TYPE, bytes(n_tokens * array(VOCAB_ID_TYPE).itemsize))
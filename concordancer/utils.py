@@ -1,16 +1,143 @@
 import re
+import unicodedata
 from typing import Union
 
 REGEX_META = set('[].^$*+{}|()')
 ESCAPE = chr(92)
 SPECIAL_SET = {r'\d', r'\D', r'\s', r'\S', r'\w', r'\W'}
+FLAG_MARK = chr(0)
+WITHIN_UNITS = {
+    's': 's', 'sent': 's', 'sentence': 's',
+    'doc': 'doc', 'text': 'doc',
+}
+WITHIN_CLAUSE = re.compile(r'\s+within\s+(\w+)\s*;?\s*$')
 
-def queryMatchToken(queryTerm: dict, corpToken: dict):
+
+def fold_case(x: str):
+    return x.lower()
+
+
+def fold_diacritics(x: str):
+    # Strip diacritics, and unify full-/half-width forms with NFKC
+    x = ''.join( ch for ch in unicodedata.normalize('NFKD', x) if not unicodedata.combining(ch) )
+    return unicodedata.normalize('NFKC', x)
+
+
+DEFAULT_NORMALIZERS = {
+    'c': fold_case,
+    'd': fold_diacritics,
+}
+
+
+def parse_cql(cql: str, default_attr: Union[str, int]="word", max_quant: int=6):
+    """Parse a CQL query with ``cqls``, with support for flags on 
+    attribute values, e.g., ``[word="the"%c]``
+
+    Flags are kept in the parsed values (see :func:`value_flags`).
+    A ``within`` clause at the end of the query is dropped (see 
+    :func:`split_within`).
+    """
+    import cqls
+    cql, _ = split_within(cql)
+    return cqls.parse(encode_flags(cql), default_attr=default_attr, max_quant=max_quant)
+
+
+def split_within(cql: str):
+    """Split a ``within`` clause, e.g., ``within s`` or ``within doc``,
+    off the end of a CQL query
+
+    Returns
+    -------
+    tuple
+        The query without the clause, and the structure the matches
+        are confined to: ``"s"`` (sentence), ``"doc"`` (document), or
+        None if the query has no ``within`` clause
+
+    Raises
+    ------
+    ValueError
+        If the structure in the ``within`` clause is unknown
+    """
+    m = WITHIN_CLAUSE.search(cql)
+    if m is None:
+        return cql, None
+    unit = m.group(1)
+    if unit not in WITHIN_UNITS:
+        raise ValueError(f"Unknown structure in CQL: within {unit}")
+    return cql[:m.start()], WITHIN_UNITS[unit]
+
+
+def encode_flags(cql: str):
+    """Move ``%<flags>`` after an attribute value into the value,
+    as ``"<FLAG_MARK><flags><FLAG_MARK><value>"``, which ``cqls`` 
+    passes through untouched
+    """
+    out = []
+    in_quotes = False
+    value_start = None
+    i = 0
+    while i < len(cql):
+        ch = cql[i]
+        if in_quotes and ch == ESCAPE:
+            out.append(cql[i:i + 2])
+            i += 2
+            continue
+        out.append(ch)
+        i += 1
+        if ch != '"':
+            continue
+        if not in_quotes:
+            in_quotes = True
+            value_start = len(out)
+            continue
+        in_quotes = False
+        flags = re.match(r'%([a-zA-Z]+)', cql[i:])
+        if flags:
+            out.insert(value_start, FLAG_MARK + flags.group(1) + FLAG_MARK)
+            i += flags.end()
+    return ''.join(out)
+
+
+def value_flags(x: str):
+    """Split a parsed CQL value into its flags and the value itself
+
+    Returns
+    -------
+    tuple
+        ``(flags, value)``, where ``flags`` is a string of the sorted,
+        distinct flag characters ('' if no flag is given)
+    """
+    if x.startswith(FLAG_MARK):
+        end = x.index(FLAG_MARK, 1)
+        return ''.join(sorted(set(x[1:end]))), x[end + 1:]
+    return '', x
+
+
+def fold_function(flags: str, normalizers: dict=None):
+    """Compose the normalizers of flags into a single function
+    """
+    if normalizers is None:
+        normalizers = DEFAULT_NORMALIZERS
+    funcs = []
+    for flag in flags:
+        if flag not in normalizers:
+            raise ValueError(f"Unknown CQL flag %{flag}")
+        funcs.append(normalizers[flag])
+
+    def fold(x):
+        for func in funcs:
+            x = func(x)
+        return x
+    
+    return fold
+
+
+def queryMatchToken(queryTerm: dict, corpToken: dict, normalizers: dict=None):
     if 'match' in queryTerm:
         positive_matched_tag = 0
         for tag, values in queryTerm.get('match').items():
             if tag not in corpToken: return False
-            if allValues_match_token(values, tag, corpToken): 
+            if allValues_match_token(values, tag, corpToken, normalizers): 
                 positive_matched_tag += 1
         
         if positive_matched_tag != len(queryTerm.get('match')):
@@ -23,13 +150,13 @@ def queryMatchToken(queryTerm: dict, corpToken: dict):
             target_value = corpToken.get(tag, None)
             for value in values:
                 counter += 1
+                flags, value = value_flags(value)
                 value, mode = match_mode(value)
                 if mode == "literal":
-                    if value != target_value:
+                    if target_value is None or not value_matches(value, mode, flags, target_value, normalizers):
                         negative_matched_tag += 1
                 else:
-                    value = append_regex_anchors(value)
-                    if (target_value != None) and (not re.search(value, target_value)):
+                    if (target_value != None) and (not value_matches(value, mode, flags, target_value, normalizers)):
                         negative_matched_tag += 1
         
         if negative_matched_tag != counter:
@@ -39,7 +166,7 @@ def queryMatchToken(queryTerm: dict, corpToken: dict):
 
 
 
-def allValues_match_token(values:list, tag:Union[str, int] , target: dict) -> bool:
+def allValues_match_token(values:list, tag:Union[str, int] , target: dict, normalizers: dict=None) -> bool:
     """Check whether all CQL generated values match a token in corpus
 
     Parameters
@@ -50,6 +177,9 @@ def allValues_match_token(values:list, tag:Union[str, int] , target: dict) -> bo
         Attribute of the token
     target : dict
         A token object retrieved from the corpus
+    normalizers : dict, optional
+        Normalizers of the flags on values, by default None, which 
+        uses :data:`DEFAULT_NORMALIZERS`
 
     Returns
     -------
@@ -59,18 +189,83 @@ def allValues_match_token(values:list, tag:Union[str, int] , target: dict) -> bo
     matched_num = 0
 
     for value in values:
+        flags, value = value_flags(value)
         value, mode = match_mode(value)
-        if mode == "regex":
-            value = append_regex_anchors(value)
-            if re.search(value, target[tag]):
-                matched_num += 1
-        if mode == "literal":
-            if value == target[tag]:
-                matched_num += 1
+        if value_matches(value, mode, flags, target[tag], normalizers):
+            matched_num += 1
     
     return matched_num == len(values)
 
 
+def value_matches(value: str, mode: str, flags: str, target_value, normalizers: dict=None) -> bool:
+    """Check whether a value in CQL, after :func:`value_flags` and 
+    :func:`match_mode`, matches the value of a token's attribute
+
+    With flags, the token's value is normalized before comparison.
+    A literal value is normalized in the same way, and so are the 
+    literal characters of a regex (see :func:`fold_regex`).
+    """
+    re_flags = 0
+    if flags:
+        fold = fold_function(flags, normalizers)
+        if isinstance(target_value, str):
+            target_value = fold(target_value)
+        if mode == "literal":
+            value = fold(value)
+        else:
+            value = fold_regex(value, fold)
+            if 'c' in flags:
+                re_flags = re.IGNORECASE
+    if mode == "regex":
+        return re.search(append_regex_anchors(value), target_value, re_flags) is not None
+    return value == target_value
+
+
+def fold_regex(pattern: str, fold):
+    """Normalize the literal characters of a regex with ``fold``, so
+    that the regex matches values normalized by ``fold``
+
+    ``fold`` is applied to one character at a time. Metacharacters,
+    escape sequences (e.g., ``\\d``), and the syntax of group 
+    extensions (e.g., the name in ``(?P<name>...)`` or the flags in 
+    ``(?i)``) are kept as they are.
+    """
+    out = []
+    i = 0
+    while i < len(pattern):
+        ch = pattern[i]
+        if ch == ESCAPE:
+            # Named characters, e.g. \N{DIGIT ONE}, are kept whole
+            end = pattern.find('}', i) + 1 if pattern.startswith('N{', i + 1) else i + 2
+            out.append(pattern[i:end or len(pattern)])
+            i = end or len(pattern)
+            continue
+        if pattern.startswith('(?', i):
+            end = _group_extension_end(pattern, i + 2)
+            out.append(pattern[i:end])
+            i = end
+            continue
+        out.append(ch if ch in REGEX_META or ch == '?' else fold(ch))
+        i += 1
+    return ''.join(out)
+
+
+def _group_extension_end(pattern: str, i: int):
+    # End of the syntax of a group extension starting at ``pattern[i]``,
+    # right after "(?"
+    if pattern.startswith('P<', i):
+        end = pattern.find('>', i)
+    elif pattern.startswith('P=', i) or pattern.startswith('(', i):
+        end = pattern.find(')', i)
+    else:
+        # Inline flags, e.g. (?i) or (?i-s:...)
+        end = i
+        while end < len(pattern) and pattern[end] in 'aiLmsux-':
+            end += 1
+        return end
+    return len(pattern) if end < 0 else end + 1
+
+
 def append_regex_anchors(x: str):
     # x = "(" + x + ")"
     if not x.startswith('^'):
@@ -13,6 +13,7 @@ setup(name='concordancer',
       author_email='liao961120@github.com',
       license='MIT',
       packages=['concordancer'],
-      install_requires=['cqls', 'tabulate', 'falcon', 'falcon-cors'],
+      install_requires=['cqls', 'falcon', 'falcon-cors'],
+      entry_points={'console_scripts': ['concordancer=concordancer.cli:main']},
       #tests_require=['cqls'],
       zip_safe=False)